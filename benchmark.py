@@ -0,0 +1,390 @@
+"""Time the stages of the data model on deterministic synthetic data and compare saved runs.
+
+Usage:
+  benchmark.py run [--days=<d>] [--model-hours=<h>] [--repeat=<n>] [--seed=<s>] [--only=<names>] [--output=<path>]
+  benchmark.py compare <baseline> <current> [--threshold=<t>]
+  benchmark.py list
+
+Options:
+  --days=<d>         Days of synthetic pod, cgm and treatment history [default: 7]
+  --model-hours=<h>  Hours of the end-to-end data model, ending with the history [default: 24]
+  --repeat=<n>       Timed runs of every benchmark [default: 5]
+  --seed=<s>         Seed of the generators [default: 0]
+  --only=<names>     Comma separated benchmarks to run instead of all of them
+  --output=<path>    Results file [default: benchmarks/<time>.json]
+  --threshold=<t>    Ratio of the current to the baseline time reported as a regression [default: 1.2]
+"""
+import datetime as dt
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import scipy
+import simplejson as json
+from docopt import docopt
+
+from datamodel import get_data_model, get_infusion_list, savgol_filter, simulate_insulin_absorption_batch, \
+    simulate_insulin_action
+from ledger import DeliveryLedger
+from localcache import LocalStore
+from nsomni import bg_series_from_entries, manual_injections_from_entries, replay_pod_session, set_store
+from podsession import append_bolus_ticks, append_rate_ticks, get_ticking_seconds
+from trend import savgol_bank
+
+# synthetic history ends here, so runs on different days generate the same data
+TS_END = 1600000000.
+
+POD_HOURS = 72
+
+ACTION_TAIL_HOURS = 12
+
+
+class SyntheticData:
+    def __init__(self, days: float, seed: int):
+        rng = np.random.default_rng(seed)
+        self.ts_start = TS_END - days * 24 * 60 * 60
+        self.ts_end = TS_END
+        self.pods, self.pod_entries = generate_pods(self.ts_start, self.ts_end, rng)
+        self.bg_entries = generate_bg_entries(self.ts_start, self.ts_end, rng)
+        self.treatments = generate_treatments(self.ts_start, self.ts_end, rng)
+        self.pod_sessions = [replay_pod_session(pod["pod_id"], [pe for pe in self.pod_entries
+                                                                if pe["pod_id"] == pod["pod_id"]], pod["abandoned"])
+                             for pod in self.pods]
+
+    def get_store(self, path: str) -> LocalStore:
+        # the offline sqlite cache stands in for mongo, filled with the synthetic documents
+        store = LocalStore(path)
+        store.write('INSERT INTO bg VALUES (?, ?, ?, ?)',
+                    [(str(i), e["date"], e.get("sgv"), e.get("mbg")) for i, e in enumerate(self.bg_entries)])
+        store.write('INSERT INTO treatments VALUES (?, ?, ?)',
+                    [(str(i), e["date_field"], json.dumps(e)) for i, e in enumerate(self.treatments)])
+        store.write('INSERT INTO pods VALUES (?, ?, ?, ?)',
+                    [(p["pod_id"], p["start"], p["end"], json.dumps(p)) for p in self.pods])
+        store.write('INSERT INTO pod_entries VALUES (?, ?, ?)',
+                    [(pe["pod_id"], pe["last_command_db_id"], json.dumps(pe)) for pe in self.pod_entries])
+        return store
+
+
+def generate_pods(ts_start: float, ts_end: float, rng: np.random.Generator) -> (list, list):
+    # back to back pods of up to POD_HOURS each, the last one still running at ts_end. every few minutes
+    # to an hour a status, temp basal, temp basal cancel, bolus or bolus cancel entry, and some pods fault
+    pods = []
+    entries = []
+    command_id = 0
+    activation = ts_start - 2 * 60 * 60
+    while activation < ts_end:
+        pod_id = f"pod{len(pods)}"
+        start = activation + 60 * 60
+        end = min(activation + POD_HOURS * 60 * 60 - rng.uniform(0, 6) * 60 * 60, ts_end + 60 * 60)
+        faulted = rng.random() < 0.1 and end < ts_end
+        basal_rate = float(rng.choice([0.5, 0.85, 1.2]))
+
+        delivered = 2.85
+        reservoir = 150.
+
+        def entry(ts: float, command: str, canceled: float = 0., **parameters) -> dict:
+            nonlocal command_id
+            command_id += 1
+            return {"pod_id": pod_id, "last_command_db_id": command_id, "insulin_delivered": round(delivered, 2),
+                    "insulin_canceled": round(canceled, 2), "insulin_reservoir": round(reservoir, 2),
+                    "state_last_updated": ts, "state_active_minutes": int((ts - activation) / 60),
+                    "state_progress": 8, "fault_event": False, "var_activation_date": activation,
+                    "last_command": dict(command=command, success=True, **parameters)}
+
+        pod_entries = [entry(start, "START", hourly_rates=[basal_rate])]
+        ts = start
+        while True:
+            step = rng.uniform(3, 60) * 60
+            if ts + step >= end or ts + step >= ts_end:
+                break
+            ts += step
+            delivered += basal_rate * step / 3600
+            reservoir = max(0., reservoir - basal_rate * step / 3600)
+            r = rng.random()
+            if r < 0.3:
+                pod_entries.append(entry(ts, "TEMPBASAL", duration_hours=float(rng.choice([0.5, 1, 2])),
+                                         hourly_rate=float(rng.choice([0., 0.35, 1.5, 3.]))))
+            elif r < 0.4:
+                pod_entries.append(entry(ts, "TEMPBASAL_CANCEL"))
+            elif r < 0.55:
+                bolus = float(rng.choice([0.5, 1., 2.5, 6.]))
+                pod_entries.append(entry(ts, "BOLUS", canceled=bolus, interval=int(rng.choice([1, 2, 4]))))
+                if rng.random() < 0.2:
+                    pod_entries.append(entry(ts + 20, "BOLUS_CANCEL", canceled=bolus / 2))
+                delivered += bolus
+            else:
+                pod_entries.append(entry(ts, "STATUS"))
+
+        if end < ts_end:
+            if faulted:
+                pe = entry(end, "STATUS")
+                pe.update(fault_event=True, fault_event_rel_time=int((end - activation) / 60) - 30)
+                pod_entries.append(pe)
+            else:
+                pod_entries.append(entry(end, "DEACTIVATE"))
+
+        pods.append({"pod_id": pod_id, "start": start, "end": end if end < ts_end else None,
+                     "abandoned": False})
+        entries.extend(pod_entries)
+        activation = end
+    return pods, entries
+
+
+def generate_bg_entries(ts_start: float, ts_end: float, rng: np.random.Generator) -> list:
+    # a cgm reading every five minutes with a daily swing, noise, sensor gaps of up to two hours and the odd
+    # finger stick
+    ts = np.arange(ts_start, ts_end, 300) + rng.uniform(0, 20, int(np.ceil((ts_end - ts_start) / 300)))
+    hours = (ts - ts_start) / 3600
+    sgv = 130 + 50 * np.sin(hours / 24 * 2 * np.pi) + 25 * np.sin(hours / 3.7) + rng.normal(0, 6, len(ts))
+    keep = np.ones(len(ts), dtype=bool)
+    for gap in rng.integers(0, len(ts), len(ts) // 500):
+        keep[gap:gap + rng.integers(2, 24)] = False
+
+    entries = [{"date": int(t * 1000), "sgv": int(round(v))} for t, v in zip(ts[keep], np.clip(sgv[keep], 40, 400))]
+    for t in rng.uniform(ts_start, ts_end, len(ts) // 300):
+        entries.append({"date": int(t * 1000), "mbg": int(rng.uniform(70, 250))})
+    return sorted(entries, key=lambda e: e["date"])
+
+
+def generate_treatments(ts_start: float, ts_end: float, rng: np.random.Generator) -> list:
+    # a manual injection about every twelve hours
+    treatments = []
+    for t in np.sort(rng.uniform(ts_start, ts_end, int((ts_end - ts_start) / (12 * 60 * 60)) + 1)):
+        treatments.append({"created_at": pd.Timestamp(t, unit='s', tz='UTC').isoformat(),
+                           "date_field": int(t * 1000), "insulin": float(rng.choice([1., 2.5, 4.]))})
+    return treatments
+
+
+def get_streams(data: SyntheticData) -> (pd.DatetimeIndex, np.ndarray, list):
+    ledger = DeliveryLedger()
+    infusion_list, infusion_keys = get_infusion_list(data.pod_sessions,
+                                                     manual_injections_from_entries(data.treatments))
+    for key, infusion in zip(infusion_keys, infusion_list):
+        ledger.add_pulses(key, infusion)
+    return ledger.get_streams()
+
+
+# every benchmark prepares its inputs from the synthetic data outside of the timing and returns what is timed
+
+def bench_ticking_seconds(data: SyntheticData, args: dict):
+    starts = np.linspace(data.ts_start, data.ts_end, 10)
+    return lambda: [get_ticking_seconds(ticks, ts) for ts in starts for ticks in range(0, 601, 5)]
+
+
+def bench_rate_ticks(data: SyntheticData, args: dict):
+    segments = [s for ps in data.pod_sessions for s in ps.get_rate_segments()]
+
+    def run():
+        ticks = []
+        for segment_start, segment_end, tick_seconds in segments:
+            append_rate_ticks(segment_start, segment_end, tick_seconds, ticks)
+        return ticks
+    return run
+
+
+def bench_bolus_ticks(data: SyntheticData, args: dict):
+    sessions = []
+    for ps in data.pod_sessions:
+        ticks = []
+        for segment_start, segment_end, tick_seconds in ps.get_rate_segments():
+            append_rate_ticks(segment_start, segment_end, tick_seconds, ticks)
+        sessions.append((ticks, ps.boluses))
+
+    def run():
+        for ticks, boluses in sessions:
+            ticks = list(ticks)
+            for bolus_start, bolus_amount, p_i in boluses:
+                append_bolus_ticks(bolus_start, bolus_amount, p_i, ticks)
+    return run
+
+
+def bench_pod_entries(data: SyntheticData, args: dict):
+    return lambda: [ps.get_entries() for ps in data.pod_sessions]
+
+
+def bench_pod_entries_pulse_exact(data: SyntheticData, args: dict):
+    return lambda: [ps.get_entries(pulse_exact=True) for ps in data.pod_sessions]
+
+
+def bench_pod_replay(data: SyntheticData, args: dict):
+    grouped = [(pod, [pe for pe in data.pod_entries if pe["pod_id"] == pod["pod_id"]]) for pod in data.pods]
+    return lambda: [replay_pod_session(pod["pod_id"], entries, pod["abandoned"]) for pod, entries in grouped]
+
+
+def bench_absorption(data: SyntheticData, args: dict):
+    _, streams, _ = get_streams(data)
+    return lambda: simulate_insulin_absorption_batch(streams * 1000)
+
+
+def get_absorbed(data: SyntheticData) -> pd.Series:
+    streams_index, streams, _ = get_streams(data)
+    absorbed = simulate_insulin_absorption_batch(streams * 1000).sum(axis=0)
+    return pd.Series(absorbed, pd.date_range(start=streams_index[0], freq='T', periods=len(absorbed)))
+
+
+def bench_action(data: SyntheticData, args: dict):
+    i_absorbed = get_absorbed(data)
+    return lambda: simulate_insulin_action(i_absorbed, 50, 140)
+
+
+def bench_action_lsoda(data: SyntheticData, args: dict):
+    i_absorbed = get_absorbed(data)
+    return lambda: simulate_insulin_action(i_absorbed, 50, 140, solver='LSODA')
+
+
+def get_action_tail(data: SyntheticData) -> (np.ndarray, tuple):
+    # the decay of the insulin on board at the end of the history over ACTION_TAIL_HOURS without any more
+    q = simulate_insulin_action(get_absorbed(data), 50, 140)
+    return np.zeros(ACTION_TAIL_HOURS * 60), tuple(q.iloc[-1])
+
+
+def bench_action_tail(data: SyntheticData, args: dict):
+    i_absorbed, state = get_action_tail(data)
+    return lambda: simulate_insulin_action(i_absorbed, 50, 140, state=state)
+
+
+def bench_action_tail_lsoda(data: SyntheticData, args: dict):
+    i_absorbed, state = get_action_tail(data)
+    return lambda: simulate_insulin_action(i_absorbed, 50, 140, state=state, solver='LSODA')
+
+
+def bench_bg_series(data: SyntheticData, args: dict):
+    return lambda: bg_series_from_entries(data.bg_entries)
+
+
+def bench_savgol_filter(data: SyntheticData, args: dict):
+    bg = bg_series_from_entries(data.bg_entries)
+    return lambda: (savgol_filter(bg, 41, 2, 1, 1.0), savgol_filter(bg, 41, 3, 1, 1.0))
+
+
+def bench_savgol_bank(data: SyntheticData, args: dict):
+    bg = bg_series_from_entries(data.bg_entries)
+    filters = [(window, polyorder, deriv) for window in (11, 21, 41, 61, 81) for polyorder in (2, 3)
+               for deriv in (0, 1, 2)]
+    return lambda: savgol_bank(bg, filters)
+
+
+def bench_data_model(data: SyntheticData, args: dict):
+    # end to end from the stand-in store, without a simulation cache so every run simulates everything
+    path = os.path.join(args['directory'], 'store.db')
+    set_store(data.get_store(path))
+    ts_end = int(data.ts_end) // 60 * 60
+    ts_start = ts_end - int(float(args['--model-hours']) * 60 * 60)
+    return lambda: get_data_model(ts_start, ts_end, 50, 140)
+
+
+BENCHMARKS = {
+    'ticking_seconds': bench_ticking_seconds,
+    'rate_ticks': bench_rate_ticks,
+    'bolus_ticks': bench_bolus_ticks,
+    'pod_entries': bench_pod_entries,
+    'pod_entries_pulse_exact': bench_pod_entries_pulse_exact,
+    'pod_replay': bench_pod_replay,
+    'absorption': bench_absorption,
+    'action': bench_action,
+    'action_lsoda': bench_action_lsoda,
+    'action_tail': bench_action_tail,
+    'action_tail_lsoda': bench_action_tail_lsoda,
+    'bg_series': bench_bg_series,
+    'savgol_filter': bench_savgol_filter,
+    'savgol_bank': bench_savgol_bank,
+    'data_model': bench_data_model,
+}
+
+
+def time_runs(f, repeat: int) -> list:
+    f()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def get_environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'scipy': scipy.__version__, 'machine': platform.machine(), 'processor': platform.processor(),
+            'commit': commit}
+
+
+def run_benchmarks(names: list, args: dict) -> dict:
+    days = float(args['--days'])
+    seed = int(args['--seed'])
+    repeat = int(args['--repeat'])
+    data = SyntheticData(days, seed)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        args = dict(args, directory=directory)
+        for name in names:
+            times = time_runs(BENCHMARKS[name](data, args), repeat)
+            results[name] = {'best': min(times), 'median': statistics.median(times), 'times': times}
+            print(f"{name:<24} best {min(times) * 1000:10.2f}ms  median {statistics.median(times) * 1000:10.2f}ms")
+        set_store(None)
+
+    return {'time': dt.datetime.now().isoformat(timespec='seconds'), 'environment': get_environment(),
+            'parameters': {'days': days, 'model_hours': float(args['--model-hours']), 'seed': seed,
+                           'repeat': repeat},
+            'results': results}
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> list:
+    # the benchmarks of both runs whose best time grew by more than threshold times
+    if baseline['parameters'] != current['parameters']:
+        print(f"parameters differ: {baseline['parameters']} and {current['parameters']}")
+    for key in sorted(set(baseline['environment']) | set(current['environment'])):
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            print(f"{key}: {baseline['environment'].get(key)} -> {current['environment'].get(key)}")
+
+    regressions = []
+    for name in [name for name in BENCHMARKS if name in baseline['results'] and name in current['results']]:
+        before = baseline['results'][name]['best']
+        after = current['results'][name]['best']
+        ratio = after / before if before > 0 else float('inf')
+        slower = ratio > threshold
+        if slower:
+            regressions.append(name)
+        print(f"{name:<24} {before * 1000:10.2f}ms -> {after * 1000:10.2f}ms  x{ratio:5.2f}"
+              f"{'  slower' if slower else ''}")
+    return regressions
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    if args['list']:
+        for name in BENCHMARKS:
+            print(name)
+    elif args['run']:
+        names = list(BENCHMARKS) if args['--only'] is None else args['--only'].split(',')
+        unknown = [name for name in names if name not in BENCHMARKS]
+        if len(unknown) > 0:
+            sys.exit(f"unknown benchmarks {', '.join(unknown)}")
+
+        results = run_benchmarks(names, args)
+        output = args['--output']
+        if output == 'benchmarks/<time>.json':
+            output = os.path.join('benchmarks', f"{dt.datetime.now():%Y%m%d-%H%M%S}.json")
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+        print(f"saved {output}")
+    elif args['compare']:
+        with open(args['<baseline>']) as stream:
+            baseline = json.load(stream)
+        with open(args['<current>']) as stream:
+            current = json.load(stream)
+        if len(compare_results(baseline, current, float(args['--threshold']))) > 0:
+            sys.exit(1)
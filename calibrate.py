@@ -0,0 +1,196 @@
+"""Fit the insulin model parameters against CGM history.
+
+Usage:
+  calibrate.py [options]
+
+Options:
+  --hours=<h>        History window in hours, ending now [default: 72]
+  --weight=<w>       Body weight in kg [default: 50]
+  --height=<h>       Height in cm [default: 140]
+  --workers=<n>      Process pool size, 0 for one per cpu [default: 0]
+  --iterations=<n>   Maximum number of optimizer iterations [default: 100]
+  --popsize=<n>      Population size multiplier of the optimizer [default: 15]
+  --seed=<n>         Random seed of the optimizer
+"""
+import datetime as dt
+import inspect
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from docopt import docopt
+from scipy import optimize
+
+from datamodel import get_infusion_list, insulin_action_constants, savgol_filter, \
+    simulate_insulin_absorption_batch, simulate_insulin_action, DF_C_LIVER_BOUND_INSULIN, \
+    DF_C_PERIPHERAL_BOUND_INSULIN
+from ledger import DeliveryLedger
+from nsomni import get_bg_series, get_manual_injections, get_pod_sessions
+from settings import get_precursor_hours, get_savgol_window
+from solvers import NegativeCompartmentError, SolverError
+from sweep import ABSORPTION_PARAMETERS
+
+ACTION_PARAMETERS = ['k01', 'k21', 'k42', 'k24', 'k04', 'r4', 'r5']
+
+
+def get_default_parameters() -> dict:
+    defaults = {}
+    for f, names in ((simulate_insulin_absorption_batch, ABSORPTION_PARAMETERS),
+                     (insulin_action_constants, ACTION_PARAMETERS)):
+        parameters = inspect.signature(f).parameters
+        for name in names:
+            defaults[name] = parameters[name].default
+    return defaults
+
+
+def get_default_bounds(defaults: dict) -> dict:
+    bounds = {name: (value / 2, value * 2) for name, value in defaults.items()}
+    bounds['k'] = (0.3, 0.95)  # monomer ratio
+    return bounds
+
+
+class CalibrationData:
+    # everything an objective evaluation needs, fetched once and shipped to every worker process
+    def __init__(self, streams: np.ndarray, streams_start: pd.Timestamp, target: pd.Series, w: float, h: float):
+        self.streams = streams
+        self.w = w
+        self.h = h
+        target = target.dropna()
+        self.target = target.to_numpy(dtype=float)
+        self.offsets = ((target.index - streams_start) // pd.Timedelta(minutes=1)).to_numpy()
+
+
+class CalibrationResult:
+    def __init__(self, parameters: dict, objective: float, r_squared: float, iteration_times: list,
+                 evaluations: int, message: str):
+        self.parameters = parameters
+        self.objective = objective
+        self.r_squared = r_squared
+        self.iteration_times = iteration_times
+        self.evaluations = evaluations
+        self.message = message
+
+
+def get_calibration_data(ts_start: float, ts_end: float, w: float, h: float) -> CalibrationData:
+    ts_start_precursor = ts_start - dt.timedelta(hours=get_precursor_hours()).total_seconds()
+
+    pss = get_pod_sessions(ts_start_precursor, ts_end)
+    manual_injections = get_manual_injections(ts_start_precursor, ts_end)
+    bg = get_bg_series(ts_start_precursor, ts_end).resample('T').mean()
+
+    ledger = DeliveryLedger()
+    infusion_list, infusion_keys = get_infusion_list(pss, manual_injections)
+    for key, infusion in zip(infusion_keys, infusion_list):
+        ledger.add_pulses(key, infusion)
+    streams_index, streams, _ = ledger.get_streams()
+
+    target = savgol_filter(bg, get_savgol_window(), 2, 1, 1.0)
+    target = target[(target.index >= pd.to_datetime(ts_start, unit='s', utc=True)) &
+                    (target.index <= pd.to_datetime(ts_end, unit='s', utc=True)) &
+                    (target.index >= streams_index[0])]
+
+    return CalibrationData(streams * 1000, streams_index[0], target, w, h)
+
+
+def get_insulin_activity(data: CalibrationData, parameters: dict) -> np.ndarray:
+    # receptor bound insulin at every target minute
+    absorbed = simulate_insulin_absorption_batch(data.streams,
+                                                 **{p: parameters[p] for p in ABSORPTION_PARAMETERS}).sum(axis=0)
+    if len(absorbed) <= data.offsets.max():
+        absorbed = np.concatenate((absorbed, np.zeros(data.offsets.max() + 1 - len(absorbed))))
+
+    df = simulate_insulin_action(absorbed, data.w, data.h, **{p: parameters[p] for p in ACTION_PARAMETERS})
+    bound = df[DF_C_LIVER_BOUND_INSULIN].to_numpy() + df[DF_C_PERIPHERAL_BOUND_INSULIN].to_numpy()
+    return bound[data.offsets]
+
+
+def evaluate(data: CalibrationData, parameters: dict) -> (float, float):
+    # residual sum of squares and r^2 of the least squares fit bgc_diff ~ a + b * bound insulin
+    activity = get_insulin_activity(data, parameters)
+    x = np.column_stack((np.ones(len(activity)), activity))
+    coefficients, _, _, _ = np.linalg.lstsq(x, data.target, rcond=None)
+    rss = float(((data.target - x @ coefficients) ** 2).sum())
+    tss = float(((data.target - data.target.mean()) ** 2).sum())
+    return rss, 1 - rss / tss if tss > 0 else 0.
+
+
+_worker_data = None
+_worker_names = None
+_worker_defaults = None
+
+FAILED_OBJECTIVE = 1e12
+
+
+def _init_worker(data: CalibrationData, names: list, defaults: dict):
+    global _worker_data, _worker_names, _worker_defaults
+    _worker_data = data
+    _worker_names = names
+    _worker_defaults = defaults
+
+
+def _objective(x: np.ndarray) -> float:
+    try:
+        parameters = dict(_worker_defaults)
+        parameters.update(zip(_worker_names, x))
+        return evaluate(_worker_data, parameters)[0]
+    except (NegativeCompartmentError, SolverError):
+        # parameter sets the model cannot be integrated with are unusable
+        return FAILED_OBJECTIVE
+
+
+def calibrate(data: CalibrationData,
+              bounds: dict = None,
+              workers: int = None,
+              max_iterations: int = 100,
+              popsize: int = 15,
+              seed: int = None,
+              verbose: bool = True) -> CalibrationResult:
+    # differential evolution over the parameters in bounds, the population being evaluated on a process
+    # pool whose workers each receive data once at start-up
+    defaults = get_default_parameters()
+    if bounds is None:
+        bounds = get_default_bounds(defaults)
+    names = list(bounds.keys())
+    if workers is None or workers <= 0:
+        workers = os.cpu_count()
+
+    iteration_times = []
+    last = [time.perf_counter()]
+
+    def callback(xk, convergence):
+        now = time.perf_counter()
+        iteration_times.append(now - last[0])
+        last[0] = now
+        if verbose:
+            print(f"iteration {len(iteration_times)}: {iteration_times[-1]:.2f}s convergence {convergence:.4f}")
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(data, names, defaults)) as pool:
+        result = optimize.differential_evolution(_objective, [bounds[name] for name in names],
+                                                 maxiter=max_iterations, popsize=popsize, seed=seed,
+                                                 workers=pool.map, updating='deferred', polish=False,
+                                                 callback=callback)
+
+    parameters = dict(defaults)
+    parameters.update(zip(names, result.x))
+    objective, r_squared = evaluate(data, parameters)
+    return CalibrationResult(parameters, objective, r_squared, iteration_times, result.nfev, result.message)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    ts_end = dt.datetime.now().replace(second=0, microsecond=0).timestamp()
+    ts_start = ts_end - float(args['--hours']) * 60 * 60
+
+    data = get_calibration_data(ts_start, ts_end, float(args['--weight']), float(args['--height']))
+    result = calibrate(data,
+                       workers=int(args['--workers']),
+                       max_iterations=int(args['--iterations']),
+                       popsize=int(args['--popsize']),
+                       seed=None if args['--seed'] is None else int(args['--seed']))
+
+    print(result.message)
+    print(f"rss {result.objective:.4f} r^2 {result.r_squared:.4f} in {sum(result.iteration_times):.1f}s")
+    for name, value in result.parameters.items():
+        print(f"{name} = {value:.6g}")
@@ -1,8 +1,17 @@
-from scipy import signal
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import numpy as np
 import pandas as pd
 
 from nsomni import get_bg_series, get_manual_injections, get_pod_sessions
 from podsession import PodSession
+from ledger import DeliveryLedger
+from settings import get_fetch_workers, get_precursor_hours, get_savgol_causal, get_savgol_window, get_solver_steps
+from simcache import SimulationCache
+from solvers import EULER, NegativeCompartmentError, check_solver, max_difference, solve_absorption, solve_action
+from stagestats import ModelStats, NO_STATS
+from trend import CausalSavgol, savgol_bank
 import datetime as dt
 
 DF_C_BGC = 'bgc'
@@ -18,64 +27,191 @@ DF_C_INTERSTITIAL_INSULIN = 'insulin_interstitial'
 DF_C_LIVER_BOUND_INSULIN = 'insulin_liver_bound'
 DF_C_PERIPHERAL_BOUND_INSULIN = 'insulin_peripheral_bound'
 
+# mU left in the depots below which an absorption run ends once its input is over
+ABSORPTION_CLOSE_ZERO = 0.05
+
+ACTION_COLUMNS = [DF_C_PLASMA_INSULIN, DF_C_HEPATIC_INSULIN, DF_C_INTERSTITIAL_INSULIN,
+                  DF_C_LIVER_BOUND_INSULIN, DF_C_PERIPHERAL_BOUND_INSULIN]
+
+
+# the stages computing each column and the stages each stage needs the result of. pod_sessions,
+# manual_injections and bg are the fetches
+COLUMN_STAGES = {
+    DF_C_INFUSION: 'infusion',
+    DF_C_BOLUS: 'boluses',
+    DF_C_INFUSION_RATE: 'rates',
+    DF_C_BGC: 'bg',
+    DF_C_BGC_DIFF: 'bg',
+    DF_C_BGC_DIFF2: 'bg',
+    DF_C_ABSORBED_INSULIN: 'absorption',
+    DF_C_PLASMA_INSULIN: 'action',
+    DF_C_HEPATIC_INSULIN: 'action',
+    DF_C_INTERSTITIAL_INSULIN: 'action',
+    DF_C_LIVER_BOUND_INSULIN: 'action',
+    DF_C_PERIPHERAL_BOUND_INSULIN: 'action',
+}
+
+STAGE_DEPENDENCIES = {
+    'pod_sessions': [],
+    'manual_injections': [],
+    'bg': [],
+    'rates': ['pod_sessions'],
+    'boluses': ['pod_sessions', 'manual_injections'],
+    'infusion': ['pod_sessions', 'manual_injections'],
+    'absorption': ['infusion'],
+    'action': ['absorption'],
+}
+
+
+def get_required_stages(columns: list = None) -> set:
+    # every stage the columns depend on, all of them for None
+    if columns is None:
+        columns = list(COLUMN_STAGES)
+    unknown = [c for c in columns if c not in COLUMN_STAGES]
+    if len(unknown) > 0:
+        raise ValueError(f"unknown columns {', '.join(unknown)}, expected any of {', '.join(COLUMN_STAGES)}")
+
+    stages = set()
+    pending = [COLUMN_STAGES[c] for c in columns]
+    while len(pending) > 0:
+        stage = pending.pop()
+        if stage not in stages:
+            stages.add(stage)
+            pending.extend(STAGE_DEPENDENCIES[stage])
+    return stages
+
+
+def get_data_model(ts_start: int, ts_end: int, w: float, h: float, alternative_action=None,
+                   state_cache: SimulationCache = None, solver: str = EULER, columns: list = None,
+                   stats: ModelStats = NO_STATS) -> pd.DataFrame:
+    # columns selects the columns to compute, only the fetches and stages they need are run. enabled stats
+    # collect the times and counts of every stage and are attached to the model as attrs['stats']
+    stages = get_required_stages(columns)
+    ts_start_precursor = ts_start - dt.timedelta(hours=get_precursor_hours()).total_seconds()
+
+    # the fetches wait on the database independently, the pod replay runs in its fetch thread as soon as
+    # the entries arrive
+    fetches = {'pod_sessions': get_pod_sessions, 'manual_injections': get_manual_injections, 'bg': get_bg_series}
+    with ThreadPoolExecutor(max_workers=get_fetch_workers()) as executor:
+        futures = {name: executor.submit(_timed_fetch, fetch, name, stats, ts_start_precursor, ts_end)
+                   for name, fetch in fetches.items() if name in stages}
+        results = {name: future.result() for name, future in futures.items()}
+
+    df = build_data_model(ts_start, ts_end, w, h,
+                          results['pod_sessions'][0] if 'pod_sessions' in results else None,
+                          results['manual_injections'][0] if 'manual_injections' in results else None,
+                          results['bg'][0] if 'bg' in results else None,
+                          alternative_action=alternative_action, state_cache=state_cache, solver=solver,
+                          columns=columns, stats=stats)
+    df.attrs['fetch_times'] = {name: fetch_time for name, (_, fetch_time) in results.items()}
+    if stats.enabled:
+        stats.finish()
+        df.attrs['stats'] = stats
+    return df
+
 
-def get_data_model(ts_start: int, ts_end: int, w: float, h: float, alternative_action=None) -> pd.DataFrame:
-    ts_start_precursor = ts_start - dt.timedelta(hours=24).total_seconds()
+def _timed_fetch(fetch, name: str, stats: ModelStats, *args) -> (object, float):
+    with stats.stage(f"fetch_{name}"):
+        t0 = time.perf_counter()
+        result = fetch(*args, stats=stats)
+        return result, time.perf_counter() - t0
 
+
+def build_data_model(ts_start: int, ts_end: int, w: float, h: float,
+                     pss: list, manual_injections: pd.Series, bg: pd.Series,
+                     alternative_action=None, state_cache: SimulationCache = None,
+                     solver: str = EULER, columns: list = None, trend_filters: dict = None,
+                     stats: ModelStats = NO_STATS) -> pd.DataFrame:
+    # inputs the requested columns do not depend on may be None. trend_filters are the causal filters of the
+    # bg derivative columns, kept by the caller to only filter the readings that arrived since the last build
+    stages = get_required_stages(columns)
     index = pd.date_range(start=pd.to_datetime(ts_start, unit='s', utc=True),
                                           end=pd.to_datetime(ts_end, unit='s', utc=True),
                                           freq='T');
     df = pd.DataFrame(index=index)
 
-    pss = get_pod_sessions(ts_start_precursor, ts_end)
-
-    all_rates = pd.Series()
-    all_bolus = pd.Series()
-    infusion_list = []
-
-    for ps in pss:
-        if not ps.ended and alternative_action is not None:
-            ts, minute, delivered, undelivered, reservoir = ps.last_entry
-            alternative_action(ps, ts, minute, delivered, undelivered, reservoir)
-
-        pod_entries = ps.get_entries()
-        infusion_list.append(pod_entries)
-
-        all_rates = all_rates.append(ps.get_rates())
-        all_bolus = all_bolus.append(ps.get_boluses())
+    ledger = DeliveryLedger()
+
+    if 'pod_sessions' in stages:
+        with stats.stage('pod_schedules') as stage:
+            for ps in pss:
+                if not ps.ended and alternative_action is not None:
+                    ts, minute, delivered, undelivered, reservoir = ps.last_entry
+                    alternative_action(ps, ts, minute, delivered, undelivered, reservoir)
+
+                if 'rates' in stages:
+                    ledger.add_rates(ps.get_rates())
+                if 'boluses' in stages:
+                    ledger.add_boluses(ps.get_boluses())
+            stage.count(sessions=len(pss))
+
+    if 'infusion' in stages:
+        with stats.stage('ticks') as stage:
+            infusion_list, infusion_keys = get_infusion_list(pss, manual_injections)
+            if stats.enabled:
+                stage.count(infusions=len(infusion_list), minutes=sum(len(infusion) for infusion in infusion_list),
+                            pulses=int(round(sum(infusion.sum() for infusion in infusion_list) / 0.05)))
+        with stats.stage('ledger'):
+            for key, infusion in zip(infusion_keys, infusion_list):
+                ledger.add_pulses(key, infusion)
+    if 'boluses' in stages:
+        ledger.add_boluses(manual_injections)
+
+    with stats.stage('ledger'):
+        if 'infusion' in stages:
+            df[DF_C_INFUSION] = ledger.get_infusion().cumsum()
+        if 'boluses' in stages:
+            df[DF_C_BOLUS] = ledger.get_boluses()
+        if 'rates' in stages:
+            df[DF_C_INFUSION_RATE] = ledger.get_rates()
+
+    if 'bg' in stages:
+        with stats.stage('bg_resample') as stage:
+            bg = bg.resample('T').mean()
+            df[DF_C_BGC] = bg
+            stage.count(minutes=len(bg))
+        with stats.stage('bg_filters') as stage:
+            if trend_filters is None and get_savgol_causal():
+                trend_filters = get_trend_filters()
+            if trend_filters is None:
+                savgol_window = get_savgol_window()
+                filtered = savgol_bank(bg, [(savgol_window, 2, 1), (savgol_window, 3, 1)])
+                df[DF_C_BGC_DIFF] = filtered[(savgol_window, 2, 1)]
+                df[DF_C_BGC_DIFF2] = filtered[(savgol_window, 3, 1)]
+            else:
+                df[DF_C_BGC_DIFF] = trend_filters[DF_C_BGC_DIFF].filter(bg)
+                df[DF_C_BGC_DIFF2] = trend_filters[DF_C_BGC_DIFF2].filter(bg)
+            stage.count(minutes=len(bg), filters=2)
+
+    if 'absorption' in stages:
+        with stats.stage('absorption') as stage:
+            steps = get_solver_steps()
+            streams_index, streams, stream_keys = ledger.get_streams()
+            if state_cache is None:
+                absorbed = simulate_insulin_absorption_batch(streams * 1000, steps=steps, solver=solver).sum(axis=0)
+            else:
+                absorbed = simulate_insulin_absorption_cached(streams * 1000, stream_keys, streams_index,
+                                                              state_cache, steps=steps, solver=solver)
+            i_absorbed = pd.Series(absorbed, pd.date_range(start=streams_index[0], freq='T', periods=len(absorbed)))
+            df[DF_C_ABSORBED_INSULIN] = i_absorbed.cumsum() / 1000
+            stage.count(streams=len(streams), minutes=len(absorbed))
+
+    if 'action' in stages:
+        with stats.stage('action') as stage:
+            if state_cache is None:
+                df_sim = simulate_insulin_action(i_absorbed, w, h, steps=steps, solver=solver)
+            else:
+                df_sim = simulate_insulin_action_cached(i_absorbed, w, h, state_cache, steps=steps, solver=solver)
+            stage.count(minutes=len(df_sim))
 
-    manual_injections = get_manual_injections(ts_start_precursor, ts_end)
-    for i_mi in manual_injections.index:
-        single_injection = pd.Series(manual_injections.loc[i_mi], [i_mi])
-        infusion_list.append(single_injection)
-        all_bolus = all_bolus.append(single_injection)
-
-    all_infusion = pd.Series()
-    for infusion in infusion_list:
-        all_infusion = all_infusion.append(infusion)
-
-    df[DF_C_INFUSION] = all_infusion.resample('T').sum().cumsum()
-    df[DF_C_BOLUS] = all_bolus.resample('T').sum()
-    df[DF_C_INFUSION_RATE] = all_rates.resample('T').mean().ffill()
-    bg = get_bg_series(ts_start_precursor, ts_end).resample('T').mean()
-    df[DF_C_BGC] = bg
-    df[DF_C_BGC_DIFF] = savgol_filter(bg, 41, 2, 1, 1.0)
-    df[DF_C_BGC_DIFF2] = savgol_filter(bg, 41, 3, 1, 1.0)
-
-    i_absorbed = pd.Series()
-    for infusion in infusion_list:
-        i_absorbed = i_absorbed.append(simulate_insulin_absorption(infusion.resample('T').sum() * 1000))
-    i_absorbed = i_absorbed.resample('T').sum()
-    df[DF_C_ABSORBED_INSULIN] = i_absorbed.cumsum() / 1000
-
-    df_sim = simulate_insulin_action(i_absorbed, w, h)
-
-    df[DF_C_PLASMA_INSULIN] = df_sim[DF_C_PLASMA_INSULIN] / 1000
-    df[DF_C_HEPATIC_INSULIN] = df_sim[DF_C_HEPATIC_INSULIN] / 1000
-    df[DF_C_INTERSTITIAL_INSULIN] = df_sim[DF_C_INTERSTITIAL_INSULIN] / 1000
-    df[DF_C_LIVER_BOUND_INSULIN] = df_sim[DF_C_LIVER_BOUND_INSULIN] / 1000
-    df[DF_C_PERIPHERAL_BOUND_INSULIN] = df_sim[DF_C_PERIPHERAL_BOUND_INSULIN] / 1000
+        df[DF_C_PLASMA_INSULIN] = df_sim[DF_C_PLASMA_INSULIN] / 1000
+        df[DF_C_HEPATIC_INSULIN] = df_sim[DF_C_HEPATIC_INSULIN] / 1000
+        df[DF_C_INTERSTITIAL_INSULIN] = df_sim[DF_C_INTERSTITIAL_INSULIN] / 1000
+        df[DF_C_LIVER_BOUND_INSULIN] = df_sim[DF_C_LIVER_BOUND_INSULIN] / 1000
+        df[DF_C_PERIPHERAL_BOUND_INSULIN] = df_sim[DF_C_PERIPHERAL_BOUND_INSULIN] / 1000
 
+    if columns is not None:
+        return df[list(columns)]
     return df
 
 
@@ -85,8 +221,38 @@ def simulate_insulin_absorption(entries: pd.Series,
                       ka2=0.0210, # fast channel absorption rate in min
                       vmld=1.93, # saturation # mU/min
                       kmld=62.6, #midpoint # mU
-                      coe=0.009) -> pd.Series:
-
+                      coe=0.009,
+                      steps: int = 100,
+                      solver: str = EULER,
+                      rtol: float = 1e-6,
+                      atol: float = 1e-6,
+                      error_estimate: bool = False) -> pd.Series:
+    # solver is either the fixed step euler method with steps sub-steps per minute or one of the adaptive
+    # ADAPTIVE_SOLVERS run to rtol/atol. with error_estimate the largest absolute error per minute is estimated
+    # by a second run at twice the steps or a tenth of the tolerances and reported in attrs['error_estimate']
+    check_solver(solver)
+    if solver == EULER:
+        absorbed = np.array(_simulate_insulin_absorption_euler(entries, k, ka1, ka2, vmld, kmld, coe, steps))
+        if error_estimate:
+            refined = _simulate_insulin_absorption_euler(entries, k, ka1, ka2, vmld, kmld, coe, steps * 2)
+            # first order method, the error of the coarse run is about twice its distance to the refined one
+            error = 2 * max_difference(absorbed, np.array(refined))
+    else:
+        u = entries.to_numpy(dtype=float)
+        constants = k, ka1, ka2, vmld, kmld, coe
+        absorbed, _ = solve_absorption(u, constants, solver, rtol, atol, ABSORPTION_CLOSE_ZERO)
+        if error_estimate:
+            refined, _ = solve_absorption(u, constants, solver, rtol / 10, atol / 10, ABSORPTION_CLOSE_ZERO)
+            error = max_difference(absorbed, refined)
+
+    result = pd.Series(absorbed, pd.date_range(start=entries.index[0], freq='T', periods=len(absorbed)))
+    result.attrs['solver'] = solver
+    if error_estimate:
+        result.attrs['error_estimate'] = error
+    return result
+
+
+def _simulate_insulin_absorption_euler(entries: pd.Series, k, ka1, ka2, vmld, kmld, coe, steps: int) -> list:
     q1a = 0.
     q1b = 0.
     q2 = 0.
@@ -94,8 +260,7 @@ def simulate_insulin_absorption(entries: pd.Series,
     insulin_action = []
     index = 0
 
-    close_zero = 0.05
-    steps = 100
+    close_zero = ABSORPTION_CLOSE_ZERO
     ka1 /= steps
     ka2 /= steps
     vmld /= steps
@@ -130,15 +295,273 @@ def simulate_insulin_absorption(entries: pd.Series,
             q3 += dq3
 
             if min(q1a,q1b,q2,q3) < 0:
-                raise Exception
+                raise NegativeCompartmentError
 
         insulin_action.append(q3)
 
-    return pd.Series(insulin_action, pd.date_range(start=entries.index[0], freq='T', periods=len(insulin_action)))
+    return insulin_action
+
+
+def get_infusion_list(pss: list, manual_injections: pd.Series) -> (list, list):
+    # every pod session and manual injection as a series of deliveries in U, with a key identifying each
+    infusion_list = []
+    infusion_keys = []
+
+    for ps in pss:
+        infusion_list.append(ps.get_entries())
+        infusion_keys.append(ps.pod_id)
+
+    for i_mi in manual_injections.index:
+        infusion_list.append(pd.Series(manual_injections.loc[i_mi], [i_mi]))
+        infusion_keys.append(i_mi)
+
+    return infusion_list, infusion_keys
+
+
+# streams with at least this many live rows are advanced as arrays, fewer are stepped as floats
+# since numpy call overhead outweighs the vectorization below that
+BATCH_VECTOR_MIN_STREAMS = 32
+
+
+def simulate_insulin_absorption_batch(entries: np.ndarray,
+                                      k=0.67,
+                                      ka1=0.0112,
+                                      ka2=0.0210,
+                                      vmld=1.93,
+                                      kmld=62.6,
+                                      coe=0.009,
+                                      state: np.ndarray = None,
+                                      checkpoints: bool = False,
+                                      steps: int = 100,
+                                      solver: str = EULER,
+                                      rtol: float = 1e-6,
+                                      atol: float = 1e-6):
+    # entries is a (stream x minute) array of infusions in mU/min on a shared minute grid, each row is
+    # simulated on its own exactly like simulate_insulin_absorption: a row starts at its first non-zero
+    # minute and ends once past its last non-zero minute with less than close_zero mU left in the depots.
+    # the returned (stream x minute) array holds q3 and is widened to fit the longest absorption tail.
+    # rows agree with simulate_insulin_absorption to within 1e-9 relative, the only difference being
+    # the rounding of numpy's vectorized power when rows are advanced as arrays.
+    # any of the model parameters can also be given as an array with one value per stream.
+    # state optionally seeds (q1a, q1b, q2) per stream at the first minute, making seeded rows live
+    # from there on. with checkpoints the (stream x minute x 3) state at the end of every minute is
+    # returned alongside q3, ready to be passed back in as state to resume a run.
+    # with an adaptive solver every row is integrated on its own by solvers.solve_absorption.
+    entries = np.atleast_2d(np.asarray(entries, dtype=float))
+    n_streams, n_minutes = entries.shape
+
+    check_solver(solver)
+    if solver != EULER:
+        return _simulate_insulin_absorption_adaptive(entries, (k, ka1, ka2, vmld, kmld, coe), state, checkpoints,
+                                                     solver, rtol, atol)
+
+    close_zero = ABSORPTION_CLOSE_ZERO
+    ka1 = ka1 / steps
+    ka2 = ka2 / steps
+    vmld = vmld / steps
+    constants = k, ka1, ka2, vmld, kmld, coe
+    if any(np.ndim(c) > 0 for c in constants):
+        # one parameter set per stream
+        parameter_columns = [np.broadcast_to(np.asarray(c, dtype=float), (n_streams,)) for c in constants]
+        row_constants = [tuple(float(c[row]) for c in parameter_columns) + (steps,) for row in range(n_streams)]
+    else:
+        parameter_columns = None
+        row_constants = None
+        constants += (steps,)
+
+    has_input = entries != 0
+    any_input = has_input.any(axis=1)
+    first = np.where(any_input, has_input.argmax(axis=1), n_minutes)
+    last = np.where(any_input, n_minutes - 1 - has_input[:, ::-1].argmax(axis=1), -1)
+
+    if state is None:
+        state = np.zeros((n_streams, 3))
+    state = np.array(state, dtype=float).reshape((n_streams, 3))
+    seeded = state.any(axis=1)
+    first[seeded] = 0
+    any_input |= seeded
+
+    q1a, q1b, q2 = state.T.copy()
+    live = np.zeros(n_streams, dtype=bool)
+    absorbed = np.zeros((n_streams, n_minutes))
+    states = np.zeros((n_streams, n_minutes, 3)) if checkpoints else None
+
+    minute = first.min(initial=n_minutes)
+    while True:
+        live |= first == minute
+        ended = live & (minute > last) & (q1a + q1b + q2 <= close_zero)
+        if ended.any():
+            live &= ~ended
+            q1a[ended] = 0.
+            q1b[ended] = 0.
+            q2[ended] = 0.
+
+        if not live.any():
+            pending = first > minute
+            if not (pending & any_input).any():
+                break
+            minute = first[pending & any_input].min()
+            continue
+
+        if minute >= absorbed.shape[1]:
+            absorbed = np.concatenate((absorbed, np.zeros((n_streams, absorbed.shape[1] + 60))), axis=1)
+            if checkpoints:
+                states = np.concatenate((states, np.zeros((n_streams, states.shape[1] + 60, 3))), axis=1)
+
+        rows = np.flatnonzero(live)
+        if minute < n_minutes:
+            u = entries[rows, minute] / steps
+        else:
+            u = np.zeros(len(rows))
+
+        if len(rows) >= BATCH_VECTOR_MIN_STREAMS:
+            if parameter_columns is not None:
+                constants = tuple(c[rows] for c in parameter_columns) + (steps,)
+            a, b, c, q3 = _absorption_minute(q1a[rows], q1b[rows], q2[rows], u, constants, any_negative_array)
+            q1a[rows] = a
+            q1b[rows] = b
+            q2[rows] = c
+            absorbed[rows, minute] = q3
+        else:
+            for i, row in enumerate(rows):
+                q1a[row], q1b[row], q2[row], absorbed[row, minute] = \
+                    _absorption_minute(float(q1a[row]), float(q1b[row]), float(q2[row]), float(u[i]),
+                                       constants if row_constants is None else row_constants[row],
+                                       any_negative)
+        if checkpoints:
+            states[rows, minute, 0] = q1a[rows]
+            states[rows, minute, 1] = q1b[rows]
+            states[rows, minute, 2] = q2[rows]
+        minute += 1
+
+    width = max(n_minutes, minute)
+    if checkpoints:
+        return absorbed[:, :width], states[:, :width]
+    return absorbed[:, :width]
+
+
+def _simulate_insulin_absorption_adaptive(entries: np.ndarray, parameters: tuple, state: np.ndarray,
+                                          checkpoints: bool, solver: str, rtol: float, atol: float):
+    n_streams, n_minutes = entries.shape
+    parameter_columns = [np.broadcast_to(np.asarray(p, dtype=float), (n_streams,)) for p in parameters]
+    if state is not None:
+        state = np.array(state, dtype=float).reshape((n_streams, 3))
+
+    results = []
+    for row in range(n_streams):
+        has_input = np.flatnonzero(entries[row])
+        seeded = state is not None and state[row].any()
+        if len(has_input) == 0 and not seeded:
+            continue
+        first = 0 if seeded else has_input[0]
+        last = has_input[-1] if len(has_input) > 0 else -1
+        absorbed, states = solve_absorption(entries[row, first:last + 1],
+                                            tuple(float(c[row]) for c in parameter_columns),
+                                            solver, rtol, atol, ABSORPTION_CLOSE_ZERO,
+                                            None if state is None else state[row])
+        results.append((row, first, absorbed, states))
+
+    width = max([n_minutes] + [first + len(absorbed) for _, first, absorbed, _ in results])
+    absorbed_all = np.zeros((n_streams, width))
+    states_all = np.zeros((n_streams, width, 3))
+    for row, first, absorbed, states in results:
+        absorbed_all[row, first:first + len(absorbed)] = absorbed
+        states_all[row, first:first + len(states)] = states
+
+    if checkpoints:
+        return absorbed_all, states_all
+    return absorbed_all
+
+
+def simulate_insulin_absorption_cached(entries: np.ndarray, keys: list, index: pd.DatetimeIndex,
+                                       cache: SimulationCache, **params) -> np.ndarray:
+    # same as simulate_insulin_absorption_batch summed over all streams, each row of entries is looked up
+    # in the cache by its key and only simulated from the first minute it differs from the cached run
+    params_key = tuple(sorted(params.items()))
+    n_minutes = entries.shape[1]
+    results = []
+    pending = []
+
+    for row, key in zip(entries, keys):
+        has_input = np.flatnonzero(row)
+        if len(has_input) == 0:
+            continue
+        first = has_input[0]
+        inputs = row[first:has_input[-1] + 1]
+        run = cache.lookup(key, index[first], params_key, inputs)
+        if run is not None:
+            results.append((first, run.outputs))
+        else:
+            offset, outputs, states = cache.resume(key, index[first], params_key, inputs)
+            pending.append((key, first, inputs, offset, outputs, states))
+
+    if len(pending) > 0:
+        remainders = np.zeros((len(pending), max(len(p[2]) - p[3] for p in pending)))
+        state = np.zeros((len(pending), 3))
+        for i, (key, first, inputs, offset, outputs, states) in enumerate(pending):
+            remainders[i, :len(inputs) - offset] = inputs[offset:]
+            if offset > 0:
+                state[i] = states[-1]
+
+        absorbed, absorbed_states = simulate_insulin_absorption_batch(remainders, state=state, checkpoints=True,
+                                                                      **params)
+        for i, (key, first, inputs, offset, outputs, states) in enumerate(pending):
+            end = np.flatnonzero(absorbed_states[i].any(axis=1))[-1] + 1
+            if offset > 0:
+                outputs = np.concatenate((outputs, absorbed[i, :end]))
+                states = np.concatenate((states, absorbed_states[i, :end]))
+            else:
+                outputs = absorbed[i, :end]
+                states = absorbed_states[i, :end]
+            cache.store(key, index[first], params_key, inputs, outputs, states)
+            results.append((first, outputs))
+
+    total = np.zeros(max([n_minutes] + [first + len(outputs) for first, outputs in results]))
+    for first, outputs in results:
+        total[first:first + len(outputs)] += outputs
+    return total
+
+
+def _absorption_minute(q1a, q1b, q2, u, constants, any_negative):
+    k, ka1, ka2, vmld, kmld, coe, steps = constants
+    uk = k*u
+    uk1 = (1-k)*u
+    q3 = 0.0
+    for _ in range(steps):
+        qi = q1a + q1b + q2
+        kqi = 1 / (qi ** (2/3) * coe + 1)
+        ka1kqi = ka1*kqi
+        ka2kqiq1b = ka2*kqi*q1b
+
+        lda = vmld*q1a/(kmld+q1a)
+        ldb = vmld*q1b/(kmld+q1b)
+
+        dq1a = uk-ka1*q1a-lda
+        dq1b = uk1-ka2kqiq1b-ldb
+        dq2 = ka1kqi*q1a-ka1kqi*q2
+        dq3 = ka1kqi*q2+ka2kqiq1b # w/o elimination
+
+        q1a = q1a + dq1a
+        q1b = q1b + dq1b
+        q2 = q2 + dq2
+        q3 = q3 + dq3
+
+        if any_negative(q1a, q1b, q2, q3):
+            raise NegativeCompartmentError
+
+    return q1a, q1b, q2, q3
+
+
+def any_negative(*qs) -> bool:
+    return min(qs) < 0
+
+
+def any_negative_array(*qs) -> bool:
+    return min(q.min() for q in qs) < 0
 
 
 def simulate_insulin_action(
-                       i_abs: pd.Series,
+                       i_abs,
                        w: float,
                        h: float,
                        k01: float = 0.041,
@@ -147,7 +570,84 @@ def simulate_insulin_action(
                        k24: float = 0.150,
                        k04: float = 0.021,
                        r4: float = 127,
-                       r5: float = 82) -> pd.DataFrame:
+                       r5: float = 82,
+                       state: tuple = None,
+                       steps: int = 100,
+                       solver: str = EULER,
+                       rtol: float = 1e-6,
+                       atol: float = 1e-6,
+                       error_estimate: bool = False) -> pd.DataFrame:
+    # i_abs is absorbed insulin per minute as a pd.Series or a plain array, the latter gets a RangeIndex
+    # state optionally seeds (q1, q2, q3, q4, q5) before the first minute, every returned row is the
+    # state at the end of its minute and can be passed back in as state to resume from there.
+    # solver and error_estimate work as in simulate_insulin_absorption
+    if isinstance(i_abs, pd.Series):
+        index = i_abs.index
+        u = i_abs.to_numpy(dtype=float)
+    else:
+        u = np.asarray(i_abs, dtype=float)
+        index = pd.RangeIndex(len(u))
+
+    check_solver(solver)
+    if state is None:
+        state = (0., 0., 0., 0., 0.)
+    state = tuple(float(x) for x in state)
+    parameters = k01, k21, k42, k24, k04, r4, r5
+
+    if solver == EULER:
+        q = _simulate_insulin_action_euler(u, w, h, parameters, state, steps)
+        if error_estimate:
+            refined = _simulate_insulin_action_euler(u, w, h, parameters, state, steps * 2)
+            error = 2 * max_difference(q, refined)
+    else:
+        constants = insulin_action_constants(w, h, *parameters, steps=1)[:-1]
+        q = solve_action(u, constants, solver, rtol, atol, state)
+        if error_estimate:
+            error = max_difference(q, solve_action(u, constants, solver, rtol / 10, atol / 10, state))
+
+    df = pd.DataFrame(q, index=index, columns=ACTION_COLUMNS)
+    df.attrs['solver'] = solver
+    if error_estimate:
+        df.attrs['error_estimate'] = error
+    return df
+
+
+def _simulate_insulin_action_euler(u: np.ndarray, w: float, h: float, parameters: tuple, state: tuple,
+                                   steps: int) -> np.ndarray:
+    constants = insulin_action_constants(w, h, *parameters, steps=steps)
+    q = np.empty((len(u), 5))
+    insulin_action_kernel(u.tolist(), constants, state, q, any_negative)
+    return q
+
+
+def simulate_insulin_action_cached(i_abs: pd.Series, w: float, h: float, cache: SimulationCache,
+                                   key='action', **params) -> pd.DataFrame:
+    # same as simulate_insulin_action, resuming from the state cached under key at the first minute
+    # where i_abs differs from the previous run
+    params_key = (w, h) + tuple(sorted(params.items()))
+    u = i_abs.to_numpy(dtype=float)
+    start = i_abs.index[0] if len(i_abs) > 0 else None
+    offset, _, states = cache.resume(key, start, params_key, u)
+
+    q = np.empty((len(u), 5))
+    q[:offset] = states
+    q[offset:] = simulate_insulin_action(u[offset:], w, h, state=states[-1] if offset > 0 else None,
+                                         **params).to_numpy()
+    cache.store(key, start, params_key, u, q, q)
+
+    return pd.DataFrame(q, index=i_abs.index, columns=ACTION_COLUMNS)
+
+
+def insulin_action_constants(w: float,
+                             h: float,
+                             k01: float = 0.041,
+                             k21: float = 0.037,
+                             k42: float = 0.790,
+                             k24: float = 0.150,
+                             k04: float = 0.021,
+                             r4: float = 127,
+                             r5: float = 82,
+                             steps: int = 100) -> tuple:
     v1 = 45.05 * w # ml/kg
     v2 = 150 * w # ml/kg
     v3 = 4.95 * w # ml/kg
@@ -155,12 +655,11 @@ def simulate_insulin_action(
     r4 = r4 * w
     r5 = r5 * w
 
-    steps = 100
-    k01 /= steps
-    k21 /= steps
-    k42 /= steps
-    k24 /= steps
-    k04 /= steps
+    k01 = k01 / steps
+    k21 = k21 / steps
+    k42 = k42 / steps
+    k24 = k24 / steps
+    k04 = k04 / steps
 
 
     ci = 1760  # ml/m^2 1760wtf? #### L/min/m^2  2.6 to 4.2???? /min
@@ -173,48 +672,51 @@ def simulate_insulin_action(
     k13 = 0.3 * co / v3 / steps
     k53 = (k42*v2*r5) / (r4*v3)
 
-    q1 = 0.
-    q2 = 0.
-    q3 = 0.
-    q4 = 0.
-    q5 = 0.
+    return k01, k21, k31, k12, k13, k42, k24, k53, k35, k04, k05, r4, r5, steps
+
 
-    df = pd.DataFrame(index=i_abs.index)
+def insulin_action_kernel(u, constants: tuple, state: tuple, out: np.ndarray, any_negative) -> tuple:
+    # advances q1..q5 over every minute of u, writing the state at the end of each minute into out
+    k01, k21, k31, k12, k13, k42, k24, k53, k35, k04, k05, r4, r5, steps = constants
+    q1, q2, q3, q4, q5 = state
 
-    df[DF_C_PLASMA_INSULIN] = pd.Series()
-    df[DF_C_HEPATIC_INSULIN] = pd.Series()
-    df[DF_C_INTERSTITIAL_INSULIN] = pd.Series()
-    df[DF_C_LIVER_BOUND_INSULIN] = pd.Series()
-    df[DF_C_PERIPHERAL_BOUND_INSULIN] = pd.Series()
+    k1 = -(k01+k21+k31)
+    k4 = k04+k24
+    k5 = k05+k35
 
-    for index in range(len(i_abs)):
-        u1 = i_abs.iloc[index] / steps
+    for index in range(len(u)):
+        u1 = u[index] / steps
         for i in range(steps):
-            dq1 = -(k01+k21+k31)*q1 + k12*q2 + k13*q3 + u1
-            dq2 = k21*q1 - k12*q2 - k42*(1-q4/r4)*q2 + k24*q4
-            dq3 = k31*q1 - k13*q3 - k53*(1-q5/r5)*q3 + k35*q5
-            dq4 = k42*(1-q4/r4)*q2 - (k04+k24)*q4
-            dq5 = k53*(1-q5/r5)*q3 - (k05+k35)*q5
+            f42 = k42*(1-q4/r4)*q2
+            f53 = k53*(1-q5/r5)*q3
 
-            q1 += dq1
-            q2 += dq2
-            q3 += dq3
-            q4 += dq4
-            q5 += dq5
+            dq1 = k1*q1 + k12*q2 + k13*q3 + u1
+            dq2 = k21*q1 - k12*q2 - f42 + k24*q4
+            dq3 = k31*q1 - k13*q3 - f53 + k35*q5
+            dq4 = f42 - k4*q4
+            dq5 = f53 - k5*q5
 
-            if min(q1, q2, q3, q4, q5) < 0:
-                raise Exception
+            q1 = q1 + dq1
+            q2 = q2 + dq2
+            q3 = q3 + dq3
+            q4 = q4 + dq4
+            q5 = q5 + dq5
 
-        df[DF_C_PLASMA_INSULIN].iloc[index] = q1
-        df[DF_C_HEPATIC_INSULIN].iloc[index] = q2
-        df[DF_C_INTERSTITIAL_INSULIN].iloc[index] = q3
-        df[DF_C_LIVER_BOUND_INSULIN].iloc[index] = q4
-        df[DF_C_PERIPHERAL_BOUND_INSULIN].iloc[index] = q5
+            if any_negative(q1, q2, q3, q4, q5):
+                raise NegativeCompartmentError
 
-    return df
+        out[index] = q1, q2, q3, q4, q5
+
+    return q1, q2, q3, q4, q5
+
+
+def get_trend_filters() -> dict:
+    # causal counterparts of the savgol_filter columns, the newest reading is fitted with the ones before it
+    # instead of being interpolated at the edge of a centered window
+    savgol_window = get_savgol_window()
+    return {DF_C_BGC_DIFF: CausalSavgol(savgol_window, 2, 1, 1.0),
+            DF_C_BGC_DIFF2: CausalSavgol(savgol_window, 3, 1, 1.0)}
 
 
 def savgol_filter(ts: pd.Series, window_length, polyorder, deriv, delta) -> pd.Series:
-    svg = signal.savgol_filter(ts.array[:], window_length=window_length, polyorder=polyorder, deriv=deriv, delta=delta,
-                               mode='interp')
-    return pd.Series(svg[:], ts.index)
\ No newline at end of file
+    return savgol_bank(ts, [(window_length, polyorder, deriv)], delta)[(window_length, polyorder, deriv)]
\ No newline at end of file
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+LTTB = 'lttb'
+MIN_MAX = 'min_max'
+# the smallest budget each method decimates with, below it a method keeps every point
+MIN_POINTS = {LTTB: 3, MIN_MAX: 4}
+
+
+def lttb(y: np.ndarray, n_out: int) -> np.ndarray:
+    # largest triangle three buckets over evenly spaced points: the first and last point and from each of
+    # n_out - 2 buckets the point spanning the largest triangle with the point kept before it and the mean
+    # of the next bucket. returns the positions of the kept points
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    kept = np.empty(n_out, dtype=int)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        next_x = (next_start + next_end - 1) / 2
+        next_y = y[next_start:next_end].mean()
+
+        x = np.arange(start, end)
+        areas = np.abs((a - next_x) * (y[start:end] - y[a]) - (a - x) * (next_y - y[a]))
+        a = start + int(np.argmax(areas))
+        kept[i + 1] = a
+    return kept
+
+
+def min_max(y: np.ndarray, n_out: int) -> np.ndarray:
+    # the lowest and highest point of each of n_out / 2 buckets, keeping every peak of step shaped data
+    n = len(y)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+
+    buckets = np.arange(n) * (n_out // 2) // n
+    order = np.lexsort((y, buckets))
+    starts = np.flatnonzero(np.diff(buckets[order], prepend=-1))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate(([0, n - 1], order[starts], order[ends])))
+
+
+def downsample(s: pd.Series, n_out: int, method: str = LTTB) -> pd.Series:
+    # at most about n_out points of s, the budget shared among its runs of valid values in proportion to
+    # their length. runs whose share is too small for the method keep only their first and last point. the first
+    # missing value after each run is kept so plotly still breaks the line there
+    if len(s) <= n_out:
+        return s
+    select, minimum = (lttb, MIN_POINTS[LTTB]) if method == LTTB else (min_max, MIN_POINTS[MIN_MAX])
+
+    values = s.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    n_valid = int(valid.sum())
+    if n_valid == 0:
+        return s.iloc[[0, len(s) - 1]]
+
+    changes = np.flatnonzero(np.diff(np.concatenate(([False], valid, [False])).astype(int)))
+    positions = []
+    for start, end in zip(changes[::2], changes[1::2]):
+        budget = int(round(n_out * (end - start) / n_valid))
+        if budget < minimum and budget < end - start:
+            positions.append(np.unique([start, end - 1]))
+        else:
+            positions.append(select(values[start:end], budget) + start)
+        if end < len(s):
+            positions.append(np.array([end]))
+    return s.iloc[np.concatenate(positions)]
+
+
+def get_scatter(n_points: int, webgl_min_points: int):
+    # webgl draws large traces much faster than svg
+    return go.Scattergl if n_points >= webgl_min_points else go.Scatter
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+LINEAR = 'linear'
+PCHIP = 'pchip'
+QUADRATIC = 'quadratic'
+# the quadratic spline through all samples pandas interpolated with before, slow on long series
+SPLINE = 'spline'
+
+FILL_METHODS = (LINEAR, PCHIP, QUADRATIC, SPLINE)
+
+
+def fill_gaps(s: pd.Series, method: str = QUADRATIC, max_fill: int = None) -> pd.Series:
+    # fills the missing samples between known ones from the known samples around them. with max_fill only
+    # the max_fill samples before the next known one are filled. linear joins the two known samples, pchip
+    # follows the monotone cubic through them and quadratic the parabola through them and the known sample
+    # before, or after at the start
+    if method not in FILL_METHODS:
+        raise ValueError(f"unknown fill method {method}, expected one of {', '.join(FILL_METHODS)}")
+    if method == SPLINE:
+        return s.interpolate(method='polynomial', order=2, limit_area='inside', limit=max_fill,
+                             limit_direction='backward')
+
+    values = s.to_numpy(dtype=float)
+    known = np.flatnonzero(~np.isnan(values))
+    if len(known) < 2:
+        return s.copy()
+    missing = np.flatnonzero(np.isnan(values[known[0]:known[-1]])) + known[0]
+    after = np.searchsorted(known, missing)
+    if max_fill is not None:
+        fill = known[after] - missing <= max_fill
+        missing, after = missing[fill], after[fill]
+    before = after - 1
+
+    x, x0, x1 = missing.astype(float), known[before].astype(float), known[after].astype(float)
+    y0, y1 = values[known[before]], values[known[after]]
+    if method == LINEAR or len(known) == 2:
+        filled = y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+    elif method == QUADRATIC:
+        third = np.where(before > 0, before - 1, after + 1)
+        x2, y2 = known[third].astype(float), values[known[third]]
+        filled = (y0 * (x - x1) * (x - x2) / ((x0 - x1) * (x0 - x2)) +
+                  y1 * (x - x0) * (x - x2) / ((x1 - x0) * (x1 - x2)) +
+                  y2 * (x - x0) * (x - x1) / ((x2 - x0) * (x2 - x1)))
+    else:
+        slopes = pchip_slopes(known.astype(float), values[known])
+        h = x1 - x0
+        t = (x - x0) / h
+        filled = ((2 * t ** 3 - 3 * t ** 2 + 1) * y0 + (t ** 3 - 2 * t ** 2 + t) * h * slopes[before] +
+                  (-2 * t ** 3 + 3 * t ** 2) * y1 + (t ** 3 - t ** 2) * h * slopes[after])
+
+    values = values.copy()
+    values[missing] = filled
+    return pd.Series(values, s.index)
+
+
+def pchip_slopes(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # fritsch-carlson slopes at the known samples, as scipy's PchipInterpolator picks them
+    h = np.diff(x)
+    delta = np.diff(y) / h
+    slopes = np.zeros(len(x))
+
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    monotone = (np.sign(delta[:-1]) == np.sign(delta[1:])) & (delta[:-1] != 0) & (delta[1:] != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harmonic = (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:])
+    slopes[1:-1] = np.where(monotone, harmonic, 0.)
+
+    slopes[0] = _pchip_end_slope(h[0], h[1], delta[0], delta[1])
+    slopes[-1] = _pchip_end_slope(h[-1], h[-2], delta[-1], delta[-2])
+    return slopes
+
+
+def _pchip_end_slope(h0: float, h1: float, m0: float, m1: float) -> float:
+    d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+    if np.sign(d) != np.sign(m0):
+        return 0.
+    if np.sign(m0) != np.sign(m1) and abs(d) > abs(3 * m0):
+        return 3 * m0
+    return d
+
+
+class GapFiller:
+    # fills the gaps of a regularly sampled series that grows at its end. appended samples only refill the
+    # gaps they can change, the ones after the second to last known sample, and the context kept to do so is
+    # the last three known samples
+    def __init__(self, method: str = QUADRATIC, max_fill: int = None, freq: str = 'T'):
+        self.method = method
+        self.max_fill = max_fill
+        self.freq = freq
+        self.filled = None
+        self.tail = None
+
+    def append(self, s: pd.Series) -> pd.Series:
+        if len(s) == 0:
+            return self.filled
+        if self.filled is None:
+            raw = s
+            refill_from = s.index[0]
+        else:
+            if s.index[0] <= self.tail.index[-1]:
+                raise ValueError("appended samples have to follow the ones before")
+            raw = pd.concat([self.tail, s]).asfreq(self.freq)
+            known = self.tail.index[self.tail.notna()]
+            refill_from = known[-2] if len(known) >= 2 else self.tail.index[0]
+
+        filled = fill_gaps(raw, self.method, self.max_fill)
+        if self.filled is None:
+            self.filled = filled
+        else:
+            self.filled = pd.concat([self.filled[self.filled.index < refill_from], filled[refill_from:]])
+
+        known = raw.index[raw.notna()]
+        self.tail = raw[known[-3]:] if len(known) >= 3 else raw
+        return self.filled
+
+    def prune(self, before: pd.Timestamp):
+        if self.filled is not None:
+            self.filled = self.filled[self.filled.index >= before]
@@ -0,0 +1,103 @@
+"""Create or check the MongoDB indexes the nsomni fetch functions rely on.
+
+Usage:
+  indexes.py create
+  indexes.py check
+  indexes.py explain [--hours=<h>]
+
+Options:
+  --hours=<h>   Window of the explained queries in hours, ending now [default: 24]
+"""
+import sys
+import time
+
+from docopt import docopt
+from pymongo import ASCENDING
+
+from nsomni import MongoStore, TREATMENT_DATE_SLACK, get_store, iso_day
+from settings import get_ns_bg_collection_name, get_omnipy_entries_collection_name, \
+    get_omnipy_pods_collection_name
+
+
+def get_required_indexes() -> list:
+    # (db name, collection name, keys) of every index a fetch function filters or sorts on,
+    # None as db name meaning the configured nightscout database
+    return [
+        (None, get_ns_bg_collection_name(), [('date', ASCENDING)]),
+        ("nightscout", "treatments", [('created_at', ASCENDING)]),
+        ("nightscout", get_omnipy_entries_collection_name(),
+         [('pod_id', ASCENDING), ('last_command_db_id', ASCENDING)]),
+        ("nightscout", get_omnipy_pods_collection_name(), [('start', ASCENDING)]),
+        ("nightscout", get_omnipy_pods_collection_name(), [('end', ASCENDING)]),
+    ]
+
+
+def has_index(store: MongoStore, db_name: str, collection_name: str, keys: list) -> bool:
+    coll = store.get_collection(collection_name, db_name)
+    return any([tuple(k) for k in index["key"]] == [tuple(k) for k in keys]
+               for index in coll.index_information().values())
+
+
+def get_missing_indexes(store: MongoStore = None) -> list:
+    if store is None:
+        store = get_store()
+    return [(db_name, collection_name, keys) for db_name, collection_name, keys in get_required_indexes()
+            if not has_index(store, db_name, collection_name, keys)]
+
+
+def create_indexes(store: MongoStore = None) -> list:
+    # creates the missing indexes in the background and returns their names
+    if store is None:
+        store = get_store()
+    created = []
+    for db_name, collection_name, keys in get_missing_indexes(store):
+        coll = store.get_collection(collection_name, db_name)
+        created.append(coll.create_index(keys, background=True))
+    return created
+
+
+def explain_queries(ts_start: float, ts_end: float, store: MongoStore = None) -> dict:
+    # winning plan stage of each fetch query, COLLSCAN meaning it is not served by an index
+    if store is None:
+        store = get_store()
+    plans = {}
+
+    coll = store.get_collection(get_ns_bg_collection_name())
+    plans['bg'] = coll.find({'date': {'$gte': int(ts_start * 1000), '$lt': int(ts_end * 1000)}}).explain()
+
+    coll = store.get_collection("treatments", "nightscout")
+    plans['treatments'] = coll.find({'created_at': {'$gte': iso_day(ts_start - TREATMENT_DATE_SLACK),
+                                                    '$lt': iso_day(ts_end + 2 * TREATMENT_DATE_SLACK)}}).explain()
+
+    coll = store.get_collection(get_omnipy_pods_collection_name(), "nightscout")
+    plans['pods'] = coll.find({'start': {'$lte': ts_end}}).explain()
+
+    return {name: _winning_stages(plan["queryPlanner"]["winningPlan"]) for name, plan in plans.items()}
+
+
+def _winning_stages(plan: dict) -> str:
+    stages = []
+    while plan is not None:
+        stages.append(plan["stage"])
+        plan = plan.get("inputStage")
+    return " <- ".join(stages)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    if args['create']:
+        for name in create_indexes():
+            print(f"created {name}")
+    elif args['check']:
+        missing = get_missing_indexes()
+        for db_name, collection_name, keys in missing:
+            print(f"missing {db_name or 'default'}.{collection_name} {keys}")
+        if len(missing) > 0:
+            sys.exit(1)
+        print("all indexes present")
+    elif args['explain']:
+        ts_end = time.time()
+        ts_start = ts_end - float(args['--hours']) * 60 * 60
+        for name, stages in explain_queries(ts_start, ts_end).items():
+            print(f"{name}: {stages}")
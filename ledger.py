@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+NS_PER_MINUTE = 60 * 1000 * 1000 * 1000
+
+
+def to_minutes(index: pd.DatetimeIndex) -> np.ndarray:
+    # unix minute of each timestamp, the bin resample('T') would put it in
+    return np.asarray(index.asi8) // NS_PER_MINUTE
+
+
+def minute_index(first_minute: int, n_minutes: int) -> pd.DatetimeIndex:
+    return pd.date_range(start=pd.to_datetime(first_minute * NS_PER_MINUTE, unit='ns', utc=True),
+                         periods=n_minutes, freq='T')
+
+
+class DeliveryLedger:
+    # insulin deliveries of all pod sessions and manual injections kept as integer unix minutes and amounts,
+    # binned onto a minute grid once all of them are added
+    def __init__(self):
+        self.stream_keys = []
+        self.pulse_minutes = []
+        self.pulse_amounts = []
+        self.bolus_minutes = []
+        self.bolus_amounts = []
+        self.rate_minutes = []
+        self.rate_values = []
+
+    def add_pulses(self, key, pulses: pd.Series):
+        # one infusion stream, identified by key, with the amount of insulin delivered at each timestamp
+        if len(pulses) == 0:
+            return
+        self.stream_keys.append(key)
+        self.pulse_minutes.append(to_minutes(pulses.index))
+        self.pulse_amounts.append(pulses.to_numpy(dtype=float))
+
+    def add_boluses(self, boluses: pd.Series):
+        if len(boluses) == 0:
+            return
+        self.bolus_minutes.append(to_minutes(boluses.index))
+        self.bolus_amounts.append(boluses.to_numpy(dtype=float))
+
+    def add_rates(self, rates: pd.Series):
+        if len(rates) == 0:
+            return
+        self.rate_minutes.append(to_minutes(rates.index))
+        self.rate_values.append(rates.to_numpy(dtype=float))
+
+    def get_infusion(self) -> pd.Series:
+        # insulin delivered per minute, from the first to the last pulse of any stream
+        return _binned_sum(self.pulse_minutes, self.pulse_amounts)
+
+    def get_boluses(self) -> pd.Series:
+        return _binned_sum(self.bolus_minutes, self.bolus_amounts)
+
+    def get_rates(self) -> pd.Series:
+        # mean rate of the rate changes within each minute, carried forward over minutes without a change
+        if len(self.rate_minutes) == 0:
+            return pd.Series(dtype=float)
+        first, minutes, values = _flatten(self.rate_minutes, self.rate_values)
+        n_minutes = minutes.max() + 1
+        counts = np.bincount(minutes, minlength=n_minutes)
+        sums = np.bincount(minutes, weights=values, minlength=n_minutes)
+        with np.errstate(invalid='ignore'):
+            rates = sums / counts
+        return pd.Series(rates, minute_index(first, n_minutes)).ffill()
+
+    def get_streams(self) -> (pd.DatetimeIndex, np.ndarray, list):
+        # (stream x minute) deliveries of every stream on the grid of get_infusion, with the stream keys
+        if len(self.pulse_minutes) == 0:
+            return minute_index(0, 0), np.zeros((0, 0)), []
+        first, minutes, values = _flatten(self.pulse_minutes, self.pulse_amounts)
+        n_streams = len(self.pulse_minutes)
+        n_minutes = minutes.max() + 1
+        rows = np.repeat(np.arange(n_streams), [len(m) for m in self.pulse_minutes])
+        streams = np.bincount(rows * n_minutes + minutes, weights=values, minlength=n_streams * n_minutes)
+        return minute_index(first, n_minutes), streams.reshape((n_streams, n_minutes)), list(self.stream_keys)
+
+
+def _flatten(minutes: list, values: list) -> (int, np.ndarray, np.ndarray):
+    minutes = np.concatenate(minutes)
+    first = minutes.min()
+    return first, minutes - first, np.concatenate(values)
+
+
+def _binned_sum(minutes: list, values: list) -> pd.Series:
+    if len(minutes) == 0:
+        return pd.Series(dtype=float)
+    first, minutes, values = _flatten(minutes, values)
+    return pd.Series(np.bincount(minutes, weights=values), minute_index(first, minutes.max() + 1))
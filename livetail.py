@@ -0,0 +1,346 @@
+"""Follow the nightscout and omnipy collections and rebuild the data model as entries arrive.
+
+Usage:
+  livetail.py [options]
+
+Options:
+  --hours-prev=<h>   Hours of history in the model [default: 8]
+  --hours-next=<h>   Hours of forecast in the model [default: 4]
+  --weight=<w>       Body weight in kg [default: 50]
+  --height=<h>       Height in cm [default: 140]
+  --poll=<s>         Polling interval in seconds where change streams are not available [default: 5]
+"""
+import copy
+import datetime as dt
+import queue
+import threading
+import time
+import traceback
+
+import pandas as pd
+from docopt import docopt
+from pymongo.errors import PyMongoError
+
+from datamodel import build_data_model, get_trend_filters, DF_C_BGC, DF_C_LIVER_BOUND_INSULIN, \
+    DF_C_PERIPHERAL_BOUND_INSULIN
+from gapfill import GapFiller
+from nsomni import MongoStore, get_store, manual_injections_from_entries, replay_pod_entry, replay_pod_session, \
+    resample_bg_entries
+from podsession import PodSession
+from settings import get_bg_fill_method, get_ns_bg_collection_name, get_omnipy_entries_collection_name, \
+    get_precursor_hours, get_simulation_cache_entries
+from simcache import SimulationCache
+from solvers import EULER
+
+BG_ENTRIES = 'bg'
+TREATMENTS = 'treatments'
+POD_ENTRIES = 'pod_entries'
+
+INSERTS = [{'$match': {'operationType': 'insert'}}]
+
+# how far back polling looks for pods, so the entries of a pod deactivated since the last poll are not missed
+POD_LOOKBACK = 60*60
+
+
+class LiveDataModel:
+    # keeps the bg entries, injections and pod sessions of the model window in memory and follows the
+    # collections for new documents, through change streams where the server supports them and by polling
+    # past the latest known document otherwise. new pod entries are replayed into their session and the
+    # model is rebuilt with a simulation cache, so only the minutes from the first changed input on are
+    # simulated again. with causal_trend the bg derivatives are filtered as readings arrive, each new one in
+    # time independent of the history instead of interpolated at the edge of a centered window. subscribers
+    # are called with the new model and the set of changed sources
+    def __init__(self, hours_prev: float, hours_next: float, w: float, h: float,
+                 store: MongoStore = None,
+                 poll_interval: float = 5,
+                 alternative_action=None,
+                 solver: str = EULER,
+                 lowest_valid_bg: int = 40, highest_valid_bg: int = 400,
+                 causal_trend: bool = True):
+        self.hours_prev = hours_prev
+        self.hours_next = hours_next
+        self.w = w
+        self.h = h
+        self.store = store if store is not None else get_store()
+        self.poll_interval = poll_interval
+        self.alternative_action = alternative_action
+        self.solver = solver
+        self.lowest_valid_bg = lowest_valid_bg
+        self.highest_valid_bg = highest_valid_bg
+
+        self.bg_entries = []
+        self.bg_keys = set()
+        self.bg_hwm = 0
+        self.bg_filler = None
+        self.bg_appended = []
+        self.bg_rewound = False
+        self.injection_entries = []
+        self.injection_keys = set()
+        self.injection_hwm = 0
+        self.pod_sessions = {}
+        self.last_command_ids = {}
+
+        self.state_cache = SimulationCache(get_simulation_cache_entries())
+        self.trend_filters = get_trend_filters() if causal_trend else None
+        self.df = None
+        self.built_at = None
+        self.events = queue.Queue()
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def subscribe(self, callback):
+        with self.subscribers_lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.subscribers_lock:
+            self.subscribers.remove(callback)
+
+    def get_data_model(self) -> pd.DataFrame:
+        return self.df
+
+    def get_window(self) -> (float, float, float):
+        ts_now = dt.datetime.now().replace(second=0, microsecond=0).timestamp()
+        ts_start = ts_now - self.hours_prev * 60 * 60
+        ts_end = ts_now + self.hours_next * 60 * 60
+        return ts_start - dt.timedelta(hours=get_precursor_hours()).total_seconds(), ts_start, ts_end
+
+    def start(self):
+        self.load()
+        self.rebuild(set())
+
+        bg_collection = self._get_collection(get_ns_bg_collection_name(), None)
+        treatments = self._get_collection("treatments", "nightscout")
+        pod_entries = self._get_collection(get_omnipy_entries_collection_name(), "nightscout")
+        for name, coll, poll in ((BG_ENTRIES, bg_collection, self.poll_bg_entries),
+                                 (TREATMENTS, treatments, self.poll_treatments),
+                                 (POD_ENTRIES, pod_entries, self.poll_pod_entries)):
+            self.threads.append(threading.Thread(target=self.follow, args=(name, coll, poll), daemon=True))
+        self.threads.append(threading.Thread(target=self.run, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.events.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _get_collection(self, collection_name: str, db_name: str):
+        try:
+            return self.store.get_collection(collection_name, db_name)
+        except ValueError:
+            # an offline local cache has nothing to watch
+            return None
+
+    def load(self):
+        ts_precursor, _, ts_end = self.get_window()
+        self.apply(BG_ENTRIES, self.store.find_bg_entries(ts_precursor, ts_end, self.lowest_valid_bg,
+                                                          self.highest_valid_bg))
+        self.apply(TREATMENTS, self.store.find_manual_injections(ts_precursor, ts_end))
+
+        pods = self.store.find_pods(ts_precursor, ts_end)
+        pod_entries = self.store.find_pod_entries([pod["pod_id"] for pod in pods])
+        for pod in pods:
+            entries = pod_entries[pod["pod_id"]]
+            if len(entries) == 0:
+                continue
+            self.pod_sessions[pod["pod_id"]] = replay_pod_session(pod["pod_id"], entries, pod["abandoned"])
+            self.last_command_ids[pod["pod_id"]] = entries[-1]["last_command_db_id"]
+
+    def follow(self, name: str, coll, poll):
+        if coll is not None:
+            try:
+                with coll.watch(INSERTS, max_await_time_ms=1000) as stream:
+                    while not self.stopped.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self.events.put((name, [change["fullDocument"]]))
+                return
+            except PyMongoError:
+                # change streams need a replica set, anything missed meanwhile is picked up by polling
+                pass
+
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                documents = poll()
+            except PyMongoError:
+                traceback.print_exc()
+                continue
+            if len(documents) > 0:
+                self.events.put((name, documents))
+
+    def poll_bg_entries(self) -> list:
+        hwm = max(self.bg_hwm, int(self.get_window()[0] * 1000))
+        entries = self.store.find_bg_entries(hwm / 1000, time.time() + 2*60*60, self.lowest_valid_bg,
+                                             self.highest_valid_bg)
+        return [e for e in entries if e["date"] > hwm]
+
+    def poll_treatments(self) -> list:
+        hwm = max(self.injection_hwm, int(self.get_window()[0] * 1000))
+        entries = self.store.find_manual_injections(hwm / 1000, time.time() + 2*60*60)
+        return [e for e in entries if e["date_field"] > hwm]
+
+    def poll_pod_entries(self) -> list:
+        ts_now = time.time()
+        pod_ids = [pod["pod_id"] for pod in self.store.find_pods(ts_now - POD_LOOKBACK, ts_now + 80*60*60)]
+        since = {pod_id: self.last_command_ids.get(pod_id) for pod_id in pod_ids}
+        since = {pod_id: last for pod_id, last in since.items() if last is not None}
+        grouped = self.store.find_pod_entries(pod_ids, since)
+        return [pe for pod_id in pod_ids for pe in grouped[pod_id]]
+
+    def apply(self, name: str, documents: list) -> bool:
+        # adds the documents not seen before to the model inputs, True if there were any
+        changed = False
+        if name == BG_ENTRIES:
+            # late uploads, e.g. a cgm backfilling after signal loss, are merged in by date
+            for e in documents:
+                if e.get("date") is None or not self.is_valid_bg_entry(e):
+                    continue
+                e = {k: e[k] for k in ("date", "sgv", "mbg") if e.get(k) is not None}
+                key = tuple(sorted(e.items()))
+                if key in self.bg_keys:
+                    continue
+                self.bg_entries.append(e)
+                self.bg_keys.add(key)
+                if e["date"] > self.bg_hwm:
+                    self.bg_appended.append(e)
+                else:
+                    self.bg_rewound = True
+                self.bg_hwm = max(self.bg_hwm, e["date"])
+                changed = True
+            self.bg_entries.sort(key=lambda d: d["date"])
+
+        elif name == TREATMENTS:
+            for e in documents:
+                if "date_field" not in e:
+                    e = dict(e, date_field=pd.Timestamp(e["created_at"]).value // 1000000)
+                key = (e["date_field"], e.get("insulin"))
+                if e.get("insulin") is None or e["insulin"] <= 0 or key in self.injection_keys:
+                    continue
+                self.injection_entries.append({"date_field": e["date_field"], "insulin": e["insulin"]})
+                self.injection_keys.add(key)
+                self.injection_hwm = max(self.injection_hwm, e["date_field"])
+                changed = True
+            self.injection_entries.sort(key=lambda d: d["date_field"])
+
+        elif name == POD_ENTRIES:
+            for pe in sorted(documents, key=lambda d: d["last_command_db_id"]):
+                pod_id = pe["pod_id"]
+                last = self.last_command_ids.get(pod_id)
+                if pe.get("state_progress", 8) < 8 or (last is not None and pe["last_command_db_id"] <= last):
+                    continue
+                ps = self.pod_sessions.get(pod_id)
+                if ps is None:
+                    ps = PodSession()
+                    ps.id(pod_id)
+                    self.pod_sessions[pod_id] = ps
+                if not ps.ended:
+                    replay_pod_entry(ps, pe)
+                self.last_command_ids[pod_id] = pe["last_command_db_id"]
+                changed = True
+
+        return changed
+
+    def is_valid_bg_entry(self, e: dict) -> bool:
+        if e.get("mbg") is not None:
+            return True
+        return e.get("sgv") is not None and self.lowest_valid_bg <= e["sgv"] <= self.highest_valid_bg
+
+    def run(self):
+        while not self.stopped.is_set():
+            # wakes at least once a minute to move the window along
+            try:
+                events = [self.events.get(timeout=60 - time.time() % 60)]
+            except queue.Empty:
+                events = []
+            while True:
+                try:
+                    events.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+
+            changed = set()
+            for name, documents in [e for e in events if e is not None]:
+                if self.apply(name, documents):
+                    changed.add(name)
+            if self.stopped.is_set():
+                break
+            if len(changed) > 0 or self.get_window()[1] != self.built_at:
+                try:
+                    self.rebuild(changed)
+                except Exception:
+                    traceback.print_exc()
+
+    def prune(self, ts_precursor: float):
+        self.bg_entries = [e for e in self.bg_entries if e["date"] >= ts_precursor * 1000]
+        self.bg_keys = set(tuple(sorted(e.items())) for e in self.bg_entries)
+        self.injection_entries = [e for e in self.injection_entries if e["date_field"] >= ts_precursor * 1000]
+        self.injection_keys = set((e["date_field"], e["insulin"]) for e in self.injection_entries)
+        for pod_id, ps in list(self.pod_sessions.items()):
+            if ps.ended and ps.end_ts < ts_precursor:
+                del self.pod_sessions[pod_id]
+                del self.last_command_ids[pod_id]
+
+    def get_bg_series(self, ts_precursor: float) -> pd.Series:
+        # readings after the latest one only fill the gaps up to them, a late upload before it fills them all again
+        appended = resample_bg_entries(self.bg_appended) if len(self.bg_appended) > 0 else None
+        if self.bg_filler is None or self.bg_rewound or \
+                (appended is not None and appended.index[0] <= self.bg_filler.tail.index[-1]):
+            self.bg_filler = GapFiller(get_bg_fill_method())
+            self.bg_filler.append(resample_bg_entries(self.bg_entries))
+        elif appended is not None:
+            self.bg_filler.append(appended)
+        self.bg_appended = []
+        self.bg_rewound = False
+        self.bg_filler.prune(pd.to_datetime(ts_precursor, unit='s', utc=True))
+        return self.bg_filler.filled
+
+    def rebuild(self, changed: set):
+        ts_precursor, ts_start, ts_end = self.get_window()
+        self.prune(ts_precursor)
+
+        pss = [ps for ps in self.pod_sessions.values() if ps.last_entry is not None]
+        if self.alternative_action is not None:
+            # the alternative action changes the sessions it is applied to, the live ones are kept as they are
+            pss = [ps if ps.ended else copy.deepcopy(ps) for ps in pss]
+
+        df = build_data_model(ts_start, ts_end, self.w, self.h, pss,
+                              manual_injections_from_entries(self.injection_entries),
+                              self.get_bg_series(ts_precursor),
+                              alternative_action=self.alternative_action, state_cache=self.state_cache,
+                              solver=self.solver, trend_filters=self.trend_filters)
+        self.df = df
+        self.built_at = ts_start
+
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(df, changed)
+            except Exception:
+                traceback.print_exc()
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    def print_update(df: pd.DataFrame, changed: set):
+        bgc = df[DF_C_BGC].dropna()
+        bound = df[DF_C_LIVER_BOUND_INSULIN] + df[DF_C_PERIPHERAL_BOUND_INSULIN]
+        print(f"{dt.datetime.now():%H:%M:%S} {','.join(sorted(changed)) or 'window'}: "
+              f"bg {bgc.iloc[-1] if len(bgc) > 0 else '-'} bound insulin {bound.iloc[-1]:.2f}")
+
+    model = LiveDataModel(float(args['--hours-prev']), float(args['--hours-next']),
+                          float(args['--weight']), float(args['--height']),
+                          poll_interval=float(args['--poll']))
+    model.subscribe(print_update)
+    model.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        model.stop()
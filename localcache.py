@@ -0,0 +1,233 @@
+import sqlite3
+import threading
+import time
+
+import simplejson as json
+from bson import ObjectId
+
+from nsomni import MongoStore, POD_ENTRY_PROJECTION, group_pod_entries, mongo_aggregate, mongo_find, \
+    pod_entry_conditions
+from settings import get_ns_bg_collection_name, get_omnipy_entries_collection_name, \
+    get_omnipy_pods_collection_name
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS bg (id TEXT PRIMARY KEY, date INTEGER, sgv REAL, mbg REAL);
+CREATE INDEX IF NOT EXISTS bg_date ON bg (date);
+CREATE TABLE IF NOT EXISTS treatments (id TEXT PRIMARY KEY, date_field INTEGER, doc TEXT);
+CREATE INDEX IF NOT EXISTS treatments_date_field ON treatments (date_field);
+CREATE TABLE IF NOT EXISTS pods (pod_id TEXT PRIMARY KEY, start REAL, "end" REAL, doc TEXT);
+CREATE TABLE IF NOT EXISTS pod_entries (pod_id TEXT, last_command_db_id INTEGER, doc TEXT,
+                                        PRIMARY KEY (pod_id, last_command_db_id));
+'''
+
+TREATMENT_DATE_FIELD = {'$convert': {'input': {'$toDate': '$created_at'}, 'to': 'long'}}
+
+
+class LocalStore:
+    # sqlite copy of the nightscout and omnipy collections with the query interface of MongoStore. each query
+    # first pulls what upstream has beyond the cached high-water mark of its table (at most once every
+    # sync_interval seconds) and then answers from the local tables. without upstream it works offline from
+    # whatever was synced before. documents changed upstream below a high-water mark are not picked up
+    def __init__(self, path: str, upstream: MongoStore = None, sync_interval: float = 10):
+        self.path = path
+        self.upstream = upstream
+        self.sync_interval = sync_interval
+        self.last_sync = {}
+        self.db_lock = threading.Lock()
+        self.sync_locks = {table: threading.Lock() for table in ('bg', 'treatments', 'pods', 'pod_entries')}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db_lock:
+            self.db.executescript(SCHEMA)
+
+    def execute(self, sql: str, parameters=()) -> list:
+        with self.db_lock:
+            return self.db.execute(sql, parameters).fetchall()
+
+    def write(self, sql: str, rows: list, meta: dict = None):
+        with self.db_lock, self.db:
+            self.db.executemany(sql, rows)
+            if meta is not None:
+                self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                    [(k, json.dumps(v)) for k, v in meta.items()])
+
+    def get_meta(self, key: str):
+        rows = self.execute('SELECT value FROM meta WHERE key = ?', (key,))
+        return json.loads(rows[0][0]) if len(rows) > 0 else None
+
+    def is_due(self, table: str) -> bool:
+        return self.upstream is not None and \
+               time.monotonic() - self.last_sync.get(table, float('-inf')) >= self.sync_interval
+
+    def sync_bg(self, ts_start: float):
+        # readings are pulled by insertion order past the highest _id cached, so a cgm backfilling older
+        # readings after signal loss is picked up too. a cache synced before ids were tracked catches up by date
+        coll = self.upstream.get_collection(get_ns_bg_collection_name())
+        start = int(ts_start * 1000)
+        synced_from = self.get_meta('bg_from')
+        hwm = self.get_meta('bg_hwm')
+        id_hwm = self.get_meta('bg_id_hwm')
+
+        # the readings of the earlier range pulled below synced_from may have been inserted after others that
+        # are not cached yet, so only the full and the incremental queries move the id high-water mark
+        queries = []
+        if synced_from is None:
+            queries.append(({'date': {'$gte': start}}, True))
+        else:
+            if start < synced_from:
+                queries.append(({'date': {'$gte': start, '$lt': synced_from}}, False))
+            if self.is_due('bg'):
+                if id_hwm is not None:
+                    queries.append(({'_id': {'$gt': ObjectId(id_hwm)}}, True))
+                else:
+                    queries.append(({'date': {'$gte': hwm if hwm is not None else synced_from}}, True))
+        if len(queries) == 0:
+            return
+
+        rows = []
+        ids = []
+        for query, tracked in queries:
+            for e in mongo_find(coll, query, projection={'date': 1, 'sgv': 1, 'mbg': 1}):
+                rows.append((str(e['_id']), e['date'], e.get('sgv'), e.get('mbg')))
+                if tracked and isinstance(e['_id'], ObjectId):
+                    ids.append(e['_id'])
+        dates = [r[1] for r in rows if r[1] is not None]
+        if hwm is not None:
+            dates.append(hwm)
+        if id_hwm is not None:
+            ids.append(ObjectId(id_hwm))
+        self.write('INSERT OR REPLACE INTO bg VALUES (?, ?, ?, ?)', rows,
+                   {'bg_from': start if synced_from is None else min(start, synced_from),
+                    'bg_hwm': max(dates) if len(dates) > 0 else None,
+                    'bg_id_hwm': str(max(ids)) if len(ids) > 0 else None})
+        self.last_sync['bg'] = time.monotonic()
+
+    def find_bg_entries(self, ts_start: float, ts_end: float, lowest_valid_bg: int, highest_valid_bg: int) -> list:
+        if self.upstream is not None:
+            with self.sync_locks['bg']:
+                self.sync_bg(ts_start)
+
+        rows = self.execute('SELECT date, sgv, mbg FROM bg WHERE date >= ? AND date < ? '
+                            'AND ((sgv >= ? AND sgv <= ?) OR mbg IS NOT NULL) ORDER BY date',
+                            (int(ts_start * 1000), int(ts_end * 1000), lowest_valid_bg, highest_valid_bg))
+        entries = []
+        for date, sgv, mbg in rows:
+            e = {'date': date}
+            if sgv is not None:
+                e['sgv'] = sgv
+            if mbg is not None:
+                e['mbg'] = mbg
+            entries.append(e)
+        return entries
+
+    def sync_treatments(self, ts_start: float):
+        synced_from = self.get_meta('treatments_from')
+        hwm = self.get_meta('treatments_hwm')
+
+        entries = []
+        fetched = False
+        if synced_from is None or ts_start < synced_from:
+            ts_end = synced_from if synced_from is not None else time.time() + 365*24*60*60
+            entries.extend(self.upstream.find_manual_injections(ts_start, ts_end))
+            fetched = True
+        if synced_from is not None and self.is_due('treatments'):
+            if hwm is None:
+                entries.extend(self.upstream.find_manual_injections(synced_from, time.time() + 365*24*60*60))
+            else:
+                coll = self.upstream.get_collection("treatments", "nightscout")
+                entries.extend(mongo_aggregate(coll, [
+                    {'$match': {'_id': {'$gt': ObjectId(hwm)}, 'insulin': {'$gt': 0}}},
+                    {'$addFields': {'date_field': TREATMENT_DATE_FIELD}}]))
+            fetched = True
+        if not fetched:
+            return
+
+        ids = [e['_id'] for e in entries if isinstance(e['_id'], ObjectId)]
+        if hwm is not None:
+            ids.append(ObjectId(hwm))
+        rows = [(str(e['_id']), e['date_field'],
+                 json.dumps({k: v for k, v in e.items() if k != '_id'}, default=str)) for e in entries]
+        self.write('INSERT OR REPLACE INTO treatments VALUES (?, ?, ?)', rows,
+                   {'treatments_from': ts_start if synced_from is None else min(ts_start, synced_from),
+                    'treatments_hwm': str(max(ids)) if len(ids) > 0 else None})
+        self.last_sync['treatments'] = time.monotonic()
+
+    def find_manual_injections(self, ts_start: float, ts_end: float,
+                               db_name: str = "nightscout", collection_name: str = "treatments") -> list:
+        if (db_name, collection_name) != ("nightscout", "treatments"):
+            if self.upstream is None:
+                raise ValueError(f"{db_name}.{collection_name} is not cached")
+            return self.upstream.find_manual_injections(ts_start, ts_end, db_name, collection_name)
+
+        if self.upstream is not None:
+            with self.sync_locks['treatments']:
+                self.sync_treatments(ts_start)
+
+        rows = self.execute('SELECT doc FROM treatments WHERE date_field >= ? AND date_field <= ? '
+                            'ORDER BY date_field', (ts_start * 1000, ts_end * 1000))
+        return [json.loads(doc) for doc, in rows]
+
+    def sync_pods(self):
+        if not self.is_due('pods'):
+            return
+        coll = self.upstream.get_collection(get_omnipy_pods_collection_name(), "nightscout")
+        latest_start = self.execute('SELECT max(start) FROM pods')[0][0]
+        open_pods = [pod_id for pod_id, in self.execute('SELECT pod_id FROM pods WHERE "end" IS NULL')]
+
+        query = {}
+        if latest_start is not None:
+            query = {'$or': [{'start': {'$gte': latest_start}}, {'end': None}, {'pod_id': {'$in': open_pods}}]}
+        rows = [(p['pod_id'], p.get('start'), p.get('end'),
+                 json.dumps({k: v for k, v in p.items() if k != '_id'}, default=str))
+                for p in mongo_find(coll, query)]
+        self.write('INSERT OR REPLACE INTO pods VALUES (?, ?, ?, ?)', rows)
+        self.last_sync['pods'] = time.monotonic()
+
+    def find_pods(self, start_ts: float, end_ts: float) -> list:
+        if self.upstream is not None:
+            with self.sync_locks['pods']:
+                self.sync_pods()
+
+        rows = self.execute('SELECT doc FROM pods WHERE start <= ? AND ("end" IS NULL OR "end" >= ?) '
+                            'ORDER BY start', (end_ts, start_ts))
+        return [json.loads(doc) for doc, in rows]
+
+    def sync_pod_entries(self, pod_ids: list):
+        if not self.is_due('pod_entries') and all(self.get_meta(f'pod_entries:{pod_id}') for pod_id in pod_ids):
+            return
+
+        hwms = dict(self.execute(f'SELECT pod_id, max(last_command_db_id) FROM pod_entries '
+                                 f'WHERE pod_id IN ({",".join("?" * len(pod_ids))}) GROUP BY pod_id', pod_ids))
+        coll = self.upstream.get_collection(get_omnipy_entries_collection_name(), "nightscout")
+        entries = mongo_find(coll, pod_entry_conditions(pod_ids, hwms), projection=POD_ENTRY_PROJECTION)
+
+        rows = [(e['pod_id'], e['last_command_db_id'], json.dumps(e, default=str)) for e in entries]
+        self.write('INSERT OR REPLACE INTO pod_entries VALUES (?, ?, ?)', rows,
+                   {f'pod_entries:{pod_id}': True for pod_id in pod_ids})
+        self.last_sync['pod_entries'] = time.monotonic()
+
+    def find_pod_entries(self, pod_ids: list, since: dict = None) -> dict:
+        pod_ids = list(pod_ids)
+        if len(pod_ids) == 0:
+            return {}
+        if self.upstream is not None:
+            with self.sync_locks['pod_entries']:
+                self.sync_pod_entries(pod_ids)
+
+        rows = self.execute(f'SELECT pod_id, last_command_db_id, doc FROM pod_entries '
+                            f'WHERE pod_id IN ({",".join("?" * len(pod_ids))}) ORDER BY last_command_db_id', pod_ids)
+        if since is None:
+            since = {}
+        return group_pod_entries([json.loads(doc) for pod_id, last_id, doc in rows
+                                  if pod_id not in since or last_id > since[pod_id]], pod_ids)
+
+    def get_collection(self, collection_name: str, db_name: str = None):
+        if self.upstream is None:
+            raise ValueError("no upstream collections in offline mode")
+        return self.upstream.get_collection(collection_name, db_name)
+
+    def close(self):
+        with self.db_lock:
+            self.db.close()
+        if self.upstream is not None:
+            self.upstream.close()
@@ -1,4 +1,5 @@
-from datetime import time
+import threading
+import time
 
 from pymongo import CursorType, MongoClient
 from pymongo.collection import Collection
@@ -6,7 +7,11 @@ from pymongo.cursor import Cursor
 
 from podsession import PodSession
 from settings import get_mongo_uri, get_db_name, get_ns_bg_collection_name, get_omnipy_entries_collection_name, \
-    get_omnipy_pods_collection_name
+    get_omnipy_pods_collection_name, get_mongo_max_pool_size, get_mongo_connect_timeout_ms, \
+    get_mongo_server_selection_timeout_ms, get_mongo_socket_timeout_ms, get_cache_path, get_cache_offline, \
+    get_cache_sync_interval_seconds, get_bg_fill_method
+from gapfill import fill_gaps
+from stagestats import ModelStats, NO_STATS
 import pandas as pd
 
 def mongo_aggregate(coll: Collection, pipeline) -> []:
@@ -25,21 +30,92 @@ def mongo_result(cc: Cursor) -> []:
     return ret
 
 
-
-def get_bg_series(ts_start: float,
-                  ts_end: float = None,
-                  lowest_valid_bg: int = 40, highest_valid_bg: int = 400,
-                  freq: str = 'T', max_fill: int = None,
-                  include_manual_entries: bool = True) -> pd.Series:
-    if ts_end is None:
-        ts_end = time.time() + 2*60*60
-
-    mongo_uri = get_mongo_uri()
-    db_name = get_db_name()
-    collection_name = get_ns_bg_collection_name()
-
-    with MongoClient(mongo_uri) as client:
-        db = client[db_name]
+POD_ENTRY_PROJECTION = {
+    '_id': 0,
+    'pod_id': 1,
+    'last_command_db_id': 1,
+    'insulin_delivered': 1,
+    'insulin_canceled': 1,
+    'insulin_reservoir': 1,
+    'state_last_updated': 1,
+    'state_active_minutes': 1,
+    'fault_event': 1,
+    'fault_event_rel_time': 1,
+    'var_activation_date': 1,
+    'last_command.command': 1,
+    'last_command.success': 1,
+    'last_command.hourly_rates': 1,
+    'last_command.duration_hours': 1,
+    'last_command.hourly_rate': 1,
+    'last_command.interval': 1,
+}
+
+
+TREATMENT_DATE_SLACK = 24*60*60
+
+
+def iso_day(ts: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def pod_entry_conditions(pod_ids: list, since: dict = None) -> dict:
+    # all entries of the pods not in since in one $in, and only those past the last_command_db_id in since
+    # for the others
+    if since is None:
+        since = {}
+    unseen = [pod_id for pod_id in pod_ids if pod_id not in since]
+    conditions = [{'pod_id': pod_id, 'last_command_db_id': {'$gt': since[pod_id]}}
+                  for pod_id in pod_ids if pod_id in since]
+    if len(conditions) == 0:
+        return {'pod_id': {'$in': unseen}, 'state_progress': {'$gte': 8}}
+    if len(unseen) > 0:
+        conditions.insert(0, {'pod_id': {'$in': unseen}})
+    return {'$or': conditions, 'state_progress': {'$gte': 8}}
+
+
+def group_pod_entries(entries: list, pod_ids: list) -> dict:
+    grouped = {pod_id: [] for pod_id in pod_ids}
+    for pe in entries:
+        grouped[pe["pod_id"]].append(pe)
+    return grouped
+
+
+class MongoStore:
+    # owns the one pooled MongoClient all fetch functions share. pass client to use an existing one,
+    # otherwise it is created from the settings the first time it is needed
+    def __init__(self,
+                 client: MongoClient = None,
+                 mongo_uri: str = None,
+                 db_name: str = None,
+                 max_pool_size: int = None,
+                 connect_timeout_ms: int = None,
+                 server_selection_timeout_ms: int = None,
+                 socket_timeout_ms: int = None):
+        self.client = client
+        self.owns_client = client is None
+        self.mongo_uri = mongo_uri
+        self.db_name = db_name
+        self.max_pool_size = max_pool_size
+        self.connect_timeout_ms = connect_timeout_ms
+        self.server_selection_timeout_ms = server_selection_timeout_ms
+        self.socket_timeout_ms = socket_timeout_ms
+        self.lock = threading.Lock()
+
+    def get_client(self) -> MongoClient:
+        with self.lock:
+            if self.client is None:
+                self.client = MongoClient(
+                    self.mongo_uri or get_mongo_uri(),
+                    maxPoolSize=self.max_pool_size or get_mongo_max_pool_size(),
+                    connectTimeoutMS=self.connect_timeout_ms or get_mongo_connect_timeout_ms(),
+                    serverSelectionTimeoutMS=self.server_selection_timeout_ms or get_mongo_server_selection_timeout_ms(),
+                    socketTimeoutMS=self.socket_timeout_ms or get_mongo_socket_timeout_ms())
+            return self.client
+
+    def get_collection(self, collection_name: str, db_name: str = None) -> Collection:
+        return self.get_client()[db_name or self.db_name or get_db_name()].get_collection(collection_name)
+
+    def find_bg_entries(self, ts_start: float, ts_end: float, lowest_valid_bg: int, highest_valid_bg: int) -> list:
         db_filter = {
             '$and': [
                 {'date': {'$gte': int(ts_start * 1000)}},
@@ -61,9 +137,114 @@ def get_bg_series(ts_start: float,
             '_id': 0
         }
 
-        coll = db.get_collection(collection_name)
-        entries = mongo_find(coll, db_filter, projection=project, sort=[("date", 1)])
-        df = pd.DataFrame(entries)
+        coll = self.get_collection(get_ns_bg_collection_name())
+        return mongo_find(coll, db_filter, projection=project, sort=[("date", 1)])
+
+    def find_manual_injections(self, ts_start: float, ts_end: float,
+                               db_name: str = "nightscout", collection_name: str = "treatments") -> list:
+        # created_at is an ISO 8601 string, so the range is first matched on the string itself, which the
+        # created_at index can serve, widened by a day for utc offsets. only those documents are converted
+        # for the exact comparison
+        created_at_filter = {
+            '$and': [
+                {'created_at': {'$gte': iso_day(ts_start - TREATMENT_DATE_SLACK)}},
+                {'created_at': {'$lt': iso_day(ts_end + 2 * TREATMENT_DATE_SLACK)}},
+                {'insulin': {'$gt': 0}}
+                ]}
+
+        db_filter = {
+            '$and': [
+                {'date_field': {'$lte': ts_end*1000}},
+                {'date_field': {'$gte': ts_start*1000}}
+                ]}
+
+        agg = [{'$match': created_at_filter},
+               {'$addFields': {'date_field': {'$convert': {'input': {'$toDate': '$created_at'}, 'to': 'long'}}}},
+               {'$match': db_filter}
+               ]
+
+        coll = self.get_collection(collection_name, db_name)
+        return mongo_aggregate(coll, agg)
+
+    def find_pods(self, start_ts: float, end_ts: float) -> list:
+        coll = self.get_collection(get_omnipy_pods_collection_name(), "nightscout")
+        return mongo_find(coll, {
+            'start': {'$lte': end_ts},
+            '$or': [{'end': None}, {'end': {'$gte': start_ts}}],
+        })
+
+    def find_pod_entries(self, pod_ids: list, since: dict = None) -> dict:
+        # entries of all pods in one query, grouped by pod_id in last_command_db_id order
+        coll = self.get_collection(get_omnipy_entries_collection_name(), "nightscout")
+        entries = mongo_find(coll, pod_entry_conditions(pod_ids, since), [('last_command_db_id', 1)],
+                             POD_ENTRY_PROJECTION)
+        return group_pod_entries(entries, pod_ids)
+
+    def close(self):
+        with self.lock:
+            if self.client is not None and self.owns_client:
+                self.client.close()
+                self.client = None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> MongoStore:
+    # the local cache in front of mongodb when a cache path is configured, offline meaning the cache alone
+    global _store
+    with _store_lock:
+        if _store is None:
+            cache_path = get_cache_path()
+            if cache_path is None:
+                _store = MongoStore()
+            else:
+                from localcache import LocalStore
+                _store = LocalStore(cache_path, None if get_cache_offline() else MongoStore(),
+                                    get_cache_sync_interval_seconds())
+        return _store
+
+
+def set_store(store: MongoStore):
+    # replaces the store used when none is passed to the fetch functions, e.g. one around a test client
+    global _store
+    with _store_lock:
+        _store = store
+
+
+def get_bg_series(ts_start: float,
+                  ts_end: float = None,
+                  lowest_valid_bg: int = 40, highest_valid_bg: int = 400,
+                  freq: str = 'T', max_fill: int = None,
+                  include_manual_entries: bool = True,
+                  store: MongoStore = None,
+                  fill_method: str = None,
+                  stats: ModelStats = NO_STATS) -> pd.Series:
+    if ts_end is None:
+        ts_end = time.time() + 2*60*60
+    if store is None:
+        store = get_store()
+
+    with stats.stage('bg_query') as stage:
+        entries = store.find_bg_entries(ts_start, ts_end, lowest_valid_bg, highest_valid_bg)
+        stage.count(documents=len(entries))
+    with stats.stage('bg_series') as stage:
+        bg = bg_series_from_entries(entries, freq, max_fill, include_manual_entries, fill_method)
+        stage.count(minutes=len(bg))
+    return bg
+
+
+def bg_series_from_entries(entries: list, freq: str = 'T', max_fill: int = None,
+                           include_manual_entries: bool = True, fill_method: str = None) -> pd.Series:
+    if fill_method is None:
+        fill_method = get_bg_fill_method()
+    return fill_gaps(resample_bg_entries(entries, freq, include_manual_entries), fill_method, max_fill)
+
+
+def resample_bg_entries(entries: list, freq: str = 'T', include_manual_entries: bool = True) -> pd.Series:
+    # the mean reading of every period, missing where there is none
+    df = pd.DataFrame(entries)
 
     index = pd.to_datetime(df['date'].convert_dtypes(convert_integer=True), unit='ms', utc=True)
     sgv = pd.Series(df['sgv'].array, index)
@@ -73,128 +254,78 @@ def get_bg_series(ts_start: float,
     else:
         sgv.dropna()
 
-    return sgv.resample(freq).mean() \
-        .interpolate(method='polynomial', order=2, limit_area='inside', limit=max_fill, limit_direction='backward')
+    return sgv.resample(freq).mean()
 
 
 def get_manual_injections(ts_start: float,
                           ts_end: float = None,
-                          db_name: str = "nightscout", collection_name: str = "treatments") -> pd.Series:
+                          db_name: str = "nightscout", collection_name: str = "treatments",
+                          store: MongoStore = None,
+                          stats: ModelStats = NO_STATS) -> pd.Series:
     if ts_end is None:
         ts_end = time.time() + 2*60*60
+    if store is None:
+        store = get_store()
 
-    mongo_uri = get_mongo_uri()
-
-    with MongoClient(mongo_uri) as client:
-        db = client[db_name]
-        db_filter = {
-            '$and': [
-                {'date_field': {'$lte': ts_end*1000}},
-                {'date_field': {'$gte': ts_start*1000}},
-                {'insulin': {'$gt': 0}}
-                ]}
+    with stats.stage('treatments_query') as stage:
+        entries = store.find_manual_injections(ts_start, ts_end, db_name, collection_name)
+        stage.count(documents=len(entries))
+    return manual_injections_from_entries(entries)
 
-        agg = [{'$addFields': {'date_field': {'$convert': {'input': {'$toDate': '$created_at'}, 'to': 'long'}}}},
-               {'$match': db_filter}
-               ]
 
-        coll = db.get_collection(collection_name)
-        entries = mongo_aggregate(coll, agg)
-        if len(entries) == 0:
-            return pd.Series()
+def manual_injections_from_entries(entries: list) -> pd.Series:
+    if len(entries) == 0:
+        return pd.Series()
 
-        df = pd.DataFrame(entries)
+    df = pd.DataFrame(entries)
 
     index = pd.to_datetime(df['date_field'], unit='ms', utc=True)
     return pd.Series(df['insulin'].array, index=index)
 
 
 def get_pod_sessions(start_ts: float,
-                        end_ts: float = None) -> list:
+                        end_ts: float = None,
+                        store: MongoStore = None,
+                        stats: ModelStats = NO_STATS) -> list:
 
     pod_sessions = []
 
-    mongo_uri = get_mongo_uri()
+    if end_ts is None:
+        end_ts = time.time() + 80*60*60
+    if store is None:
+        store = get_store()
 
-    with MongoClient(mongo_uri) as mongo_client:
-        db = mongo_client.get_database("nightscout")
-        coll = db.get_collection(get_omnipy_pods_collection_name())
-
-        if end_ts is None:
-            end_ts = time.time() + 80*60*60
-
-        pods = mongo_find(coll, {
-            'start': {'$lte': end_ts},
-            '$or': [{'end': None}, {'end': {'$gte': start_ts}}],
-        })
+    with stats.stage('pods_query') as stage:
+        pods = store.find_pods(start_ts, end_ts)
+        stage.count(documents=len(pods))
+    if len(pods) == 0:
+        return pod_sessions
 
-        coll = db.get_collection(get_omnipy_entries_collection_name())
+    with stats.stage('pod_entries_query') as stage:
+        pod_entries = store.find_pod_entries([pod["pod_id"] for pod in pods])
+        stage.count(documents=sum(len(entries) for entries in pod_entries.values()))
+    with stats.stage('pod_replay') as stage:
         for pod in pods:
-            pod_sessions.append(get_pod_session(pod["pod_id"], coll, pod["abandoned"]))
+            pod_sessions.append(replay_pod_session(pod["pod_id"], pod_entries[pod["pod_id"]], pod["abandoned"]))
+        stage.count(sessions=len(pod_sessions))
+
+    return pod_sessions
 
-        return pod_sessions
 
+def get_pod_session(pod_id: str, store: MongoStore = None, auto_remove: bool = True) -> PodSession:
+    if store is None:
+        store = get_store()
+    return replay_pod_session(pod_id, store.find_pod_entries([pod_id])[pod_id], auto_remove)
 
-def get_pod_session(pod_id: str, coll: Collection, auto_remove: bool = True) -> PodSession:
-    pod_entries = mongo_find(coll,
-                             {
-                                'pod_id': pod_id,
-                                'state_progress': { '$gte': 8 }
-                             }, [('last_command_db_id', 1)])
 
+def replay_pod_session(pod_id: str, pod_entries: list, auto_remove: bool = True) -> PodSession:
     ps = PodSession()
     ps.id(pod_id)
 
     for pe in pod_entries:
         if ps.ended:
             break
-
-        delivered = float(pe["insulin_delivered"])
-        not_delivered = float(pe["insulin_canceled"])
-        reservoir_remaining = float(pe["insulin_reservoir"])
-        ts = float(pe["state_last_updated"])
-        minute = int(pe["state_active_minutes"])
-
-        parameters = pe["last_command"]
-        command = parameters["command"]
-        success = parameters["success"]
-
-        if pe["fault_event"]:
-            pod_minute_failure = int(pe["fault_event_rel_time"])
-            log_event(f"FAULTED at minute {pod_minute_failure}", ts, minute, delivered, not_delivered,
-                      reservoir_remaining)
-            ps.fail(ts, minute, delivered, not_delivered, reservoir_remaining, pod_minute_failure)
-        elif command == "START" and success:
-            basal_rate = parameters["hourly_rates"][0]
-            activation_date = pe["var_activation_date"]
-            log_event(f"START {basal_rate}U/h", ts, minute, delivered, not_delivered, reservoir_remaining)
-            ps.start(ts, minute, delivered, not_delivered, reservoir_remaining, basal_rate, activation_date)
-        elif command == "TEMPBASAL" and success:
-            tb_duration_hours = float(parameters["duration_hours"])
-            tb_minutes = int(round(tb_duration_hours * 60, 0))
-            tb_rate = float(parameters["hourly_rate"])
-            log_event(f"TEMPBASAL {tb_rate}U/h {tb_duration_hours}h", ts, minute, delivered, not_delivered,
-                      reservoir_remaining)
-            ps.temp_basal_start(ts, minute, delivered, not_delivered, reservoir_remaining, tb_rate, tb_minutes)
-        elif command == "TEMPBASAL_CANCEL" and success:
-            log_event(f"TEMPBASAL CANCEL", ts, minute, delivered, not_delivered, reservoir_remaining)
-            ps.temp_basal_end(ts, minute, delivered, not_delivered, reservoir_remaining)
-        elif command == "BOLUS" and success:
-            if "interval" in parameters:
-                p_i = parameters["interval"]
-            else:
-                p_i = 2
-            log_event(f"BOLUS {not_delivered} interval {p_i}", ts, minute, delivered, not_delivered, reservoir_remaining)
-            ps.bolus_start(ts, minute, delivered, not_delivered, reservoir_remaining, p_i)
-        elif command == "BOLUS_CANCEL" and success:
-            log_event(f"BOLUS CANCEL", ts, minute, delivered, not_delivered, reservoir_remaining)
-            ps.bolus_end(ts, minute, delivered, not_delivered, reservoir_remaining)
-        elif command == "DEACTIVATE" and success:
-            log_event(f"DEACTIVATE", ts, minute, delivered, not_delivered, reservoir_remaining)
-            ps.deactivate(ts, minute, delivered, not_delivered, reservoir_remaining)
-        elif success:
-            log_event(f"STATUS", ts, minute, delivered, not_delivered, reservoir_remaining)
-            ps.entry(ts, minute, delivered, not_delivered, reservoir_remaining)
+        replay_pod_entry(ps, pe)
 
     if not ps.ended and auto_remove:
         ps.remove()
@@ -202,6 +333,55 @@ def get_pod_session(pod_id: str, coll: Collection, auto_remove: bool = True) ->
     return ps
 
 
+def replay_pod_entry(ps: PodSession, pe: dict):
+    delivered = float(pe["insulin_delivered"])
+    not_delivered = float(pe["insulin_canceled"])
+    reservoir_remaining = float(pe["insulin_reservoir"])
+    ts = float(pe["state_last_updated"])
+    minute = int(pe["state_active_minutes"])
+
+    parameters = pe["last_command"]
+    command = parameters["command"]
+    success = parameters["success"]
+
+    if pe["fault_event"]:
+        pod_minute_failure = int(pe["fault_event_rel_time"])
+        log_event(f"FAULTED at minute {pod_minute_failure}", ts, minute, delivered, not_delivered,
+                  reservoir_remaining)
+        ps.fail(ts, minute, delivered, not_delivered, reservoir_remaining, pod_minute_failure)
+    elif command == "START" and success:
+        basal_rate = parameters["hourly_rates"][0]
+        activation_date = pe["var_activation_date"]
+        log_event(f"START {basal_rate}U/h", ts, minute, delivered, not_delivered, reservoir_remaining)
+        ps.start(ts, minute, delivered, not_delivered, reservoir_remaining, basal_rate, activation_date)
+    elif command == "TEMPBASAL" and success:
+        tb_duration_hours = float(parameters["duration_hours"])
+        tb_minutes = int(round(tb_duration_hours * 60, 0))
+        tb_rate = float(parameters["hourly_rate"])
+        log_event(f"TEMPBASAL {tb_rate}U/h {tb_duration_hours}h", ts, minute, delivered, not_delivered,
+                  reservoir_remaining)
+        ps.temp_basal_start(ts, minute, delivered, not_delivered, reservoir_remaining, tb_rate, tb_minutes)
+    elif command == "TEMPBASAL_CANCEL" and success:
+        log_event(f"TEMPBASAL CANCEL", ts, minute, delivered, not_delivered, reservoir_remaining)
+        ps.temp_basal_end(ts, minute, delivered, not_delivered, reservoir_remaining)
+    elif command == "BOLUS" and success:
+        if "interval" in parameters:
+            p_i = parameters["interval"]
+        else:
+            p_i = 2
+        log_event(f"BOLUS {not_delivered} interval {p_i}", ts, minute, delivered, not_delivered, reservoir_remaining)
+        ps.bolus_start(ts, minute, delivered, not_delivered, reservoir_remaining, p_i)
+    elif command == "BOLUS_CANCEL" and success:
+        log_event(f"BOLUS CANCEL", ts, minute, delivered, not_delivered, reservoir_remaining)
+        ps.bolus_end(ts, minute, delivered, not_delivered, reservoir_remaining)
+    elif command == "DEACTIVATE" and success:
+        log_event(f"DEACTIVATE", ts, minute, delivered, not_delivered, reservoir_remaining)
+        ps.deactivate(ts, minute, delivered, not_delivered, reservoir_remaining)
+    elif success:
+        log_event(f"STATUS", ts, minute, delivered, not_delivered, reservoir_remaining)
+        ps.entry(ts, minute, delivered, not_delivered, reservoir_remaining)
+
+
 def log_event(msg: str, ts: float, minute: int,
               total_delivered: float, total_undelivered: float, reservoir_remaining: float):
     pass
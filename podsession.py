@@ -1,3 +1,7 @@
+import bisect
+import heapq
+
+import numpy as np
 import pandas as pd
 import datetime as dt
 
@@ -59,41 +63,91 @@ def append_rate_ticks(ts_start: float, ts_end: float, tick_seconds: list, append
         idx += 1
 
 
+def get_rate_tick_counts(ts_start: float, ts_end: float, tick_seconds: list) -> (int, np.ndarray):
+    # unix minute of the hour ts_start falls in and the number of ticks append_rate_ticks would append
+    # in every minute from there on, computed from the hourly tick pattern
+    if len(tick_seconds) == 0:
+        return 0, np.zeros(0, dtype=int)
+
+    seconds = np.asarray(tick_seconds, dtype=float)
+    ts_hour, first_idx, last_hour, last_count = _get_rate_tick_span(ts_start, ts_end, seconds)
+    minute_of_hour = (seconds // 60).astype(int)
+
+    counts = np.tile(np.bincount(minute_of_hour, minlength=60), last_hour + 1)
+    counts[:60] -= np.bincount(minute_of_hour[:first_idx], minlength=60)
+    counts[-60:] -= np.bincount(minute_of_hour[last_count:], minlength=60)
+    return int(ts_hour) // 60, counts
+
+
+def get_rate_ticks(ts_start: float, ts_end: float, tick_seconds: list,
+                   window_start: float, window_end: float) -> np.ndarray:
+    # the ticks append_rate_ticks would append within [window_start, window_end)
+    if len(tick_seconds) == 0:
+        return np.zeros(0)
+
+    seconds = np.asarray(tick_seconds, dtype=float)
+    ts_hour, first_idx, last_hour, last_count = _get_rate_tick_span(ts_start, ts_end, seconds)
+
+    ticks = []
+    for hour in range(max(0, int((window_start - ts_hour) // 3600)),
+                      min(last_hour, int((window_end - ts_hour) // 3600)) + 1):
+        lo = first_idx if hour == 0 else 0
+        hi = last_count if hour == last_hour else len(seconds)
+        ticks.append((ts_hour + hour * 3600) + seconds[lo:hi])
+
+    if len(ticks) == 0:
+        return np.zeros(0)
+    ticks = np.concatenate(ticks)
+    return ticks[(ticks >= window_start) & (ticks < window_end)]
+
+
+def _get_rate_tick_span(ts_start: float, ts_end: float, seconds: np.ndarray) -> (float, int, int, int):
+    # ticks run from index first_idx in the hour starting at ts_hour up to, but excluding, index last_count
+    # in the hour last_hour hours later, matching the walk of append_rate_ticks
+    start_second = ts_start % 3600
+    ts_hour = ts_start - start_second
+    first_idx = int(np.searchsorted(seconds, start_second, side='right'))
+    last_hour = int((ts_end - ts_hour) // 3600)
+    last_count = int(np.count_nonzero((ts_hour + last_hour * 3600) + seconds < ts_end))
+    if last_hour == 0:
+        last_count = max(last_count, first_idx)
+    return ts_hour, first_idx, last_hour, last_count
+
+
 def append_bolus_ticks(bolus_start: float, bolus_ticks: int, pulse_interval: int,
-                       append_to: list):
+                       append_to: list) -> list:
+    # inserts the bolus pulses into the sorted tick list with a single merge over the ticks they
+    # fall between and returns them
+    idx = bisect.bisect_right(append_to, bolus_start)
+    pulses, end_idx = schedule_bolus_ticks(bolus_start, bolus_ticks, pulse_interval, append_to, idx)
+    if len(pulses) > 0:
+        append_to[idx:end_idx] = heapq.merge(append_to[idx:end_idx], pulses)
+    return pulses
+
+
+def schedule_bolus_ticks(bolus_start: float, bolus_ticks: int, pulse_interval: int,
+                         tick_list: list, idx: int) -> (list, int):
+    # walks the sorted tick_list from idx, the first tick after bolus_start, placing each pulse a pulse
+    # interval after the previous pulse or tick and at least a pulse interval before the next tick.
+    # returns the pulses and the index of the first tick after the last of them
+    pulses = []
+    prev_tick = tick_list[idx - 1] if idx > 0 else None
     dx = bolus_start
-    idx = 0
-    for dt_tick in append_to:
-        if dt_tick > dx:
-            break
-        idx += 1
 
     while bolus_ticks > 0:
-        idx, dx = find_bolus_slot(idx, dx, pulse_interval, append_to)
-        append_to.insert(idx, dx)
-        idx += 1
-        dx += pulse_interval
-        bolus_ticks -= 1
-
+        if prev_tick is not None and dx - prev_tick < pulse_interval:
+            dx = prev_tick + pulse_interval
 
-def find_bolus_slot(idx: int, bolus_tick_ts: float,
-                    pulse_interval: int,
-                    tick_list: list) -> (int, float):
-    if idx > 0 and len(tick_list) > 0:
-        prev_tick = tick_list[idx - 1]
-        if bolus_tick_ts - prev_tick < pulse_interval:
-            bolus_tick_ts = prev_tick + pulse_interval
-
-    if idx < len(tick_list):
-        next_tick = tick_list[idx]
-        while next_tick - bolus_tick_ts < pulse_interval:
+        while idx < len(tick_list) and tick_list[idx] - dx < pulse_interval:
+            dx = tick_list[idx] + pulse_interval
             idx += 1
-            bolus_tick_ts = next_tick + pulse_interval
-            if idx == len(tick_list):
-                break
-            next_tick = tick_list[idx]
 
-    return idx, bolus_tick_ts
+        pulses.append(dx)
+        prev_tick = dx
+        dx += pulse_interval
+        bolus_ticks -= 1
+
+    return pulses, idx
 
 
 class PodSession:
@@ -172,9 +226,9 @@ class PodSession:
 
         return pd.Series(rates, index=pd.to_datetime(ts, unit='s', origin='unix', utc=True)) * self.precision
 
-    def get_entries(self) -> pd.Series:
-        ts_ticks = []
-        deliveries = []
+    def get_rate_segments(self) -> list:
+        # (start, end, tick seconds) of every basal and temp basal period, in delivery order
+        segments = []
 
         basal_ticks = get_ticking_seconds(self.basal_rate)
 
@@ -182,14 +236,14 @@ class PodSession:
         for rate_start, rate_end, rate in self.temp_basals:
             basal_end = rate_start
             if basal_end > basal_start:
-                append_rate_ticks(basal_start, basal_end, basal_ticks, ts_ticks)
+                segments.append((basal_start, basal_end, basal_ticks))
 
             if self.ended and rate_end > self.end_ts:
                 rate_end = self.end_ts
 
             if rate_end > rate_start:
                 tb_tick_list = get_ticking_seconds(rate)
-                append_rate_ticks(rate_start, rate_end, tb_tick_list, ts_ticks)
+                segments.append((rate_start, rate_end, tb_tick_list))
             basal_start = rate_end
 
         if self.ended:
@@ -197,7 +251,24 @@ class PodSession:
         else:
             basal_end = self.activation_ts + 80 * 60 * 60
 
-        append_rate_ticks(basal_start, basal_end, basal_ticks, ts_ticks)
+        segments.append((basal_start, basal_end, basal_ticks))
+        return segments
+
+    def get_entries(self, pulse_exact: bool = False) -> pd.Series:
+        # insulin delivered in every minute between the first and the last pulse, counted from the rate
+        # segments and the tick pattern. with pulse_exact every 0.05U pulse gets its own timestamp instead,
+        # both are the same after resample('T').sum()
+        segments = self.get_rate_segments()
+        if pulse_exact:
+            return self._get_pulse_entries(segments)
+        return self._get_minute_entries(segments)
+
+    def _get_pulse_entries(self, segments: list) -> pd.Series:
+        ts_ticks = []
+        deliveries = []
+
+        for segment_start, segment_end, tick_seconds in segments:
+            append_rate_ticks(segment_start, segment_end, tick_seconds, ts_ticks)
 
         for bolus_start, bolus_amount, p_i in self.boluses:
             append_bolus_ticks(bolus_start, bolus_amount, p_i, ts_ticks)
@@ -207,6 +278,74 @@ class PodSession:
 
         return pd.Series(deliveries, index=pd.to_datetime(ts_ticks, unit='s', origin='unix', utc=True))
 
+    def _get_minute_entries(self, segments: list) -> pd.Series:
+        minute_counts = []
+        for segment_start, segment_end, tick_seconds in segments:
+            minute_counts.append(get_rate_tick_counts(segment_start, segment_end, tick_seconds))
+
+        bolus_ticks = self._get_bolus_ticks(segments)
+        if len(bolus_ticks) > 0:
+            minutes = (np.asarray(bolus_ticks) // 60).astype(int)
+            minute_counts.append((minutes.min(), np.bincount(minutes - minutes.min())))
+
+        minute_counts = [(minute, counts) for minute, counts in minute_counts if len(counts) > 0]
+        if len(minute_counts) == 0:
+            return pd.Series(dtype=float)
+
+        start = min(minute for minute, counts in minute_counts)
+        total = np.zeros(max(minute + len(counts) for minute, counts in minute_counts) - start, dtype=int)
+        for minute, counts in minute_counts:
+            total[minute - start:minute - start + len(counts)] += counts
+        delivered = np.flatnonzero(total)
+        if len(delivered) == 0:
+            return pd.Series(dtype=float)
+        first = start + delivered[0]
+        total = total[delivered[0]:delivered[-1] + 1]
+
+        return pd.Series(total * 0.05, index=pd.to_datetime((first + np.arange(len(total))) * 60,
+                                                            unit='s', origin='unix', utc=True))
+
+    def _get_bolus_ticks(self, segments: list) -> list:
+        # schedules the boluses in order against the rate ticks around them only, kept in one sorted list that
+        # also takes the pulses of every bolus. ticks further than a pulse interval before a bolus or after its
+        # last pulse cannot move any of its pulses, a bolus running past the ticks kept has them kept again
+        # over windows twice as long
+        if len(self.boluses) == 0:
+            return []
+        boluses = sorted(self.boluses)
+        scale = 1
+        while True:
+            # the windows of the boluses, merged where they overlap
+            spans = []
+            for bolus_start, bolus_amount, p_i in boluses:
+                window_start = bolus_start - p_i - 1
+                window_end = bolus_start + ((bolus_amount + 1) * p_i * 2 + 60) * scale
+                if len(spans) > 0 and window_start <= spans[-1][1]:
+                    spans[-1][1] = max(spans[-1][1], window_end)
+                else:
+                    spans.append([window_start, window_end])
+            span_starts = [span[0] for span in spans]
+            span_ends = [span[1] for span in spans]
+
+            ticks = [np.zeros(0)]
+            for segment_start, segment_end, tick_seconds in segments:
+                for i in range(bisect.bisect_right(span_ends, segment_start),
+                               bisect.bisect_left(span_starts, segment_end)):
+                    ticks.append(get_rate_ticks(segment_start, segment_end, tick_seconds, span_starts[i],
+                                                span_ends[i]))
+            ticks = np.sort(np.concatenate(ticks)).tolist()
+
+            bolus_ticks = []
+            for bolus_start, bolus_amount, p_i in self.boluses:
+                inserted = append_bolus_ticks(bolus_start, bolus_amount, p_i, ticks)
+                if len(inserted) > 0 and \
+                        inserted[-1] + p_i >= span_ends[bisect.bisect_right(span_starts, bolus_start) - 1]:
+                    break
+                bolus_ticks.extend(inserted)
+            else:
+                return bolus_ticks
+            scale *= 2
+
     def id(self, pod_id: str):
         self.pod_id = pod_id
 
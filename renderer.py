@@ -0,0 +1,95 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import plotly.graph_objects as go
+
+
+def get_model_key(df: pd.DataFrame, **options) -> str:
+    # content address of a rendering: the data model slice it is drawn from and the options it is drawn with
+    key = hashlib.sha256()
+    key.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    key.update(repr(list(df.columns)).encode('utf-8'))
+    key.update(repr(sorted(options.items())).encode('utf-8'))
+    return key.hexdigest()
+
+
+class ImageCache:
+    # rendered images by content key, the most recent ones in memory and all of them in directory if given
+    def __init__(self, max_entries: int = 32, directory: str = None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key: str, format: str) -> str:
+        return os.path.join(self.directory, f"{key}.{format}")
+
+    def get(self, key: str, format: str = "png") -> bytes:
+        with self.lock:
+            image = self.images.get((key, format))
+            if image is not None:
+                self.images.move_to_end((key, format))
+                return image
+
+        if self.directory is None or not os.path.exists(self.get_path(key, format)):
+            return None
+        with open(self.get_path(key, format), "rb") as stream:
+            image = stream.read()
+        self._remember(key, format, image)
+        return image
+
+    def put(self, key: str, image: bytes, format: str = "png"):
+        self._remember(key, format, image)
+        if self.directory is not None:
+            # written under a temporary name first so a concurrent get never reads a partial file
+            path = self.get_path(key, format)
+            temporary = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as stream:
+                stream.write(image)
+            os.replace(temporary, path)
+
+    def _remember(self, key: str, format: str, image: bytes):
+        with self.lock:
+            self.images[(key, format)] = image
+            self.images.move_to_end((key, format))
+            while len(self.images) > self.max_entries:
+                self.images.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+
+
+class ImageRenderer:
+    # one kaleido process kept running for all renders instead of paying its start-up on each of them.
+    # kaleido talks to its process over a single pipe, so renders are serialized
+    def __init__(self):
+        self.scope = None
+        self.lock = threading.Lock()
+
+    def get_scope(self):
+        if self.scope is None:
+            from kaleido.scopes.plotly import PlotlyScope
+            self.scope = PlotlyScope()
+        return self.scope
+
+    def warm(self):
+        self.render(go.Figure(), format="png", width=10, height=10)
+
+    def render(self, figure: go.Figure, format: str = "png", width: int = None, height: int = None,
+               scale: float = None) -> bytes:
+        with self.lock:
+            # the scope restarts the process by itself if it has exited
+            return self.get_scope().transform(figure.to_dict(), format=format, width=width, height=height,
+                                              scale=scale)
+
+    def close(self):
+        with self.lock:
+            if self.scope is not None:
+                self.scope._shutdown_kaleido()
+                self.scope = None
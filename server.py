@@ -0,0 +1,186 @@
+"""Serve the data model and charts over HTTP, keeping clients and caches warm between requests.
+
+Usage:
+  server.py [options]
+
+Options:
+  --host=<h>      Address to listen on [default: 127.0.0.1]
+  --port=<p>      Port to listen on [default: 8080]
+  --workers=<n>   Models or charts computed at the same time [default: 2]
+  --weight=<w>    Body weight in kg [default: 50]
+  --height=<h>    Height in cm [default: 140]
+
+Endpoints:
+  GET /model?hours_prev=6&hours_next=6&format=json|arrow&columns=bgc,insulin_infusion_rate
+  GET /chart.png?hours_prev=6&hours_next=6&width=700
+  GET /health
+
+format=arrow needs the optional pyarrow, without it the server answers 501.
+"""
+import datetime as dt
+import threading
+import traceback
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from docopt import docopt
+
+import simple
+from datamodel import get_data_model, get_required_stages
+
+
+class Coalescer:
+    # runs at most max_concurrent computations at once, callers asking for a computation that is already
+    # running wait for its result instead of starting another one
+    def __init__(self, max_concurrent: int):
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def run(self, key, f, *args):
+        with self.lock:
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.pending[key] = future
+        if not owner:
+            return future.result()
+
+        try:
+            with self.semaphore:
+                future.set_result(f(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.pending[key]
+        return future.result()
+
+
+def get_model(hours_prev: float, hours_next: float, w: float, h: float, columns: tuple = None) -> pd.DataFrame:
+    ts_now = dt.datetime.now().replace(second=0, microsecond=0).timestamp()
+    return get_data_model(ts_now - hours_prev * 60 * 60, ts_now + hours_next * 60 * 60, w, h,
+                          state_cache=simple.state_cache, columns=None if columns is None else list(columns))
+
+
+def to_arrow(df: pd.DataFrame) -> bytes:
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class RequestError(ValueError):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path == '/health':
+                self.reply(200, 'text/plain', b'ok')
+            elif url.path == '/model':
+                self.get_model(query)
+            elif url.path == '/chart.png':
+                self.get_chart(query)
+            else:
+                self.reply(404, 'text/plain', b'not found')
+        except RequestError as e:
+            self.reply(e.status, 'text/plain', str(e).encode('utf-8'))
+        except Exception as e:
+            traceback.print_exc()
+            self.reply(500, 'text/plain', f"{type(e).__name__}: {e}".encode('utf-8'))
+
+    def get_model(self, query: dict):
+        hours_prev, hours_next = get_hours(query)
+        data_format = get_parameter(query, 'format', str, 'json')
+        if data_format not in ('json', 'arrow'):
+            raise RequestError(f"unknown format {data_format}, expected json or arrow")
+
+        columns = get_parameter(query, 'columns', str, None)
+        if columns is not None:
+            columns = tuple(columns.split(','))
+            try:
+                get_required_stages(list(columns))
+            except ValueError as e:
+                raise RequestError(str(e))
+
+        server = self.server
+        df = server.coalescer.run(('model', hours_prev, hours_next, columns), get_model, hours_prev, hours_next,
+                                  server.w, server.h, columns)
+        if data_format == 'json':
+            self.reply(200, 'application/json', df.to_json(orient='split', date_format='iso').encode('utf-8'))
+        else:
+            try:
+                body = to_arrow(df)
+            except ImportError:
+                raise RequestError("arrow output needs pyarrow installed", 501)
+            self.reply(200, 'application/vnd.apache.arrow.stream', body)
+
+    def get_chart(self, query: dict):
+        hours_prev, hours_next = get_hours(query)
+        width = get_parameter(query, 'width', int, None)
+        server = self.server
+        image = server.coalescer.run(('chart', hours_prev, hours_next, width), simple.render_simple,
+                                     hours_prev, hours_next, True, None, width, server.w, server.h)
+        self.reply(200, 'image/png', image)
+
+    def reply(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def get_parameter(query: dict, name: str, kind, default):
+    if name not in query:
+        return default
+    try:
+        return kind(query[name][0])
+    except ValueError:
+        raise RequestError(f"invalid {name} {query[name][0]}")
+
+
+def get_hours(query: dict) -> (float, float):
+    hours_prev = get_parameter(query, 'hours_prev', float, 6.)
+    hours_next = get_parameter(query, 'hours_next', float, 6.)
+    if hours_prev < 0 or hours_next < 0:
+        raise RequestError("hours_prev and hours_next cannot be negative")
+    return hours_prev, hours_next
+
+
+class ModelServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, workers: int, w: float, h: float):
+        super().__init__(address, ModelRequestHandler)
+        self.coalescer = Coalescer(workers)
+        self.w = w
+        self.h = h
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    server = ModelServer((args['--host'], int(args['--port'])), int(args['--workers']),
+                         float(args['--weight']), float(args['--height']))
+    try:
+        simple.renderer.warm()
+    except Exception:
+        # charts still render, the first one pays the start-up
+        traceback.print_exc()
+    print(f"listening on {args['--host']}:{args['--port']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,30 +1,245 @@
+import os
+import threading
+
 import simplejson as json
 
+SETTINGS_PATH_ENVIRONMENT = "PLUXY_SETTINGS"
+ENVIRONMENT_PREFIX = "PLUXY_"
+
+REQUIRED = object()
+
+# name: (type, default)
+FIELDS = {
+    "mongo_uri": (str, REQUIRED),
+    "mongo_db_name": (str, REQUIRED),
+    "mongo_bg_entries": (str, REQUIRED),
+    "mongo_treatments": (str, REQUIRED),
+    "mongo_omnipy_entries": (str, REQUIRED),
+    "mongo_omnipy_pods": (str, REQUIRED),
+    "mongo_max_pool_size": (int, 10),
+    "mongo_connect_timeout_ms": (int, 5000),
+    "mongo_server_selection_timeout_ms": (int, 10000),
+    "mongo_socket_timeout_ms": (int, 30000),
+    "cache_path": (str, None),
+    "cache_offline": (bool, False),
+    "cache_sync_interval_seconds": (float, 10.),
+    "solver_steps": (int, 100),
+    "bg_fill_method": (str, "pchip"),
+    "savgol_window": (int, 41),
+    "savgol_causal": (bool, False),
+    "precursor_hours": (float, 24.),
+    "fetch_workers": (int, 3),
+    "simulation_cache_entries": (int, 64),
+    "image_cache_entries": (int, 32),
+    "image_cache_dir": (str, None),
+    "chart_width": (int, 700),
+    "chart_points_per_pixel": (int, 2),
+    "webgl_min_points": (int, 2000),
+}
+
+
+class Settings:
+    # settings.json parsed and typed once, with PLUXY_<NAME> environment variables taking precedence over
+    # the file. missing required settings only fail when they are asked for
+    def __init__(self, values: dict, path: str = None, mtime: float = None):
+        self.path = path
+        self.mtime = mtime
+        self.values = {}
+        for name, (kind, default) in FIELDS.items():
+            value = os.environ.get(ENVIRONMENT_PREFIX + name.upper())
+            if value is None:
+                value = values.get(name, default)
+            self.values[name] = value if value is None or value is REQUIRED else _convert(kind, value)
+
+    def get(self, name: str):
+        value = self.values[name]
+        if value is REQUIRED:
+            raise KeyError(f"{name} is not set in {self.path} or {ENVIRONMENT_PREFIX + name.upper()}")
+        return value
+
+
+def _convert(kind, value):
+    if kind is bool and isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return kind(value)
+
+
+def get_settings_path() -> str:
+    # resolved once, so a later change of the working directory does not matter
+    return os.path.abspath(os.environ.get(SETTINGS_PATH_ENVIRONMENT, "settings.json"))
+
+
+def load_settings(path: str = None) -> Settings:
+    if path is None:
+        path = get_settings_path()
+    if os.path.exists(path):
+        mtime = os.path.getmtime(path)
+        with open(path, "r") as stream:
+            values = json.load(stream)
+    else:
+        mtime = None
+        values = {}
+    return Settings(values, path, mtime)
+
+
+_settings = None
+_settings_lock = threading.Lock()
+_watcher = None
+
+
+def _get_settings() -> Settings:
+    global _settings
+    settings = _settings
+    if settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = load_settings()
+            settings = _settings
+    return settings
 
-def _get_settings():
-    with open("settings.json", "r") as stream:
-        return json.load(stream)
+
+def set_settings(settings: Settings):
+    global _settings
+    with _settings_lock:
+        _settings = settings
+
+
+def reload_settings_if_changed() -> bool:
+    settings = _get_settings()
+    path = settings.path
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    if mtime == settings.mtime:
+        return False
+    set_settings(load_settings(path))
+    return True
+
+
+def watch_settings(interval: float = 2.):
+    # reloads the settings in the background whenever the file changes, values already read are not updated
+    global _watcher
+    with _settings_lock:
+        if _watcher is not None:
+            return
+        stopped = threading.Event()
+
+        def watch():
+            while not stopped.wait(interval):
+                try:
+                    reload_settings_if_changed()
+                except (OSError, ValueError):
+                    # a half written file, the next check picks up the complete one
+                    pass
+
+        _watcher = threading.Thread(target=watch, daemon=True), stopped
+        _watcher[0].start()
+
+
+def stop_watching_settings():
+    global _watcher
+    with _settings_lock:
+        watcher = _watcher
+        _watcher = None
+    if watcher is not None:
+        thread, stopped = watcher
+        stopped.set()
+        thread.join()
 
 
 def get_mongo_uri():
-    return _get_settings()["mongo_uri"]
+    return _get_settings().get("mongo_uri")
 
 
 def get_db_name():
-    return _get_settings()["mongo_db_name"]
+    return _get_settings().get("mongo_db_name")
 
 
 def get_ns_bg_collection_name():
-    return _get_settings()["mongo_bg_entries"]
+    return _get_settings().get("mongo_bg_entries")
 
 
 def get_ns_treatments_collection_name():
-    return _get_settings()["mongo_treatments"]
+    return _get_settings().get("mongo_treatments")
 
 
 def get_omnipy_entries_collection_name():
-    return _get_settings()["mongo_omnipy_entries"]
+    return _get_settings().get("mongo_omnipy_entries")
 
 
 def get_omnipy_pods_collection_name():
-    return _get_settings()["mongo_omnipy_pods"]
\ No newline at end of file
+    return _get_settings().get("mongo_omnipy_pods")
+
+
+def get_mongo_max_pool_size():
+    return _get_settings().get("mongo_max_pool_size")
+
+
+def get_mongo_connect_timeout_ms():
+    return _get_settings().get("mongo_connect_timeout_ms")
+
+
+def get_mongo_server_selection_timeout_ms():
+    return _get_settings().get("mongo_server_selection_timeout_ms")
+
+
+def get_mongo_socket_timeout_ms():
+    return _get_settings().get("mongo_socket_timeout_ms")
+
+
+def get_cache_path():
+    return _get_settings().get("cache_path")
+
+
+def get_cache_offline():
+    return _get_settings().get("cache_offline")
+
+
+def get_cache_sync_interval_seconds():
+    return _get_settings().get("cache_sync_interval_seconds")
+
+
+def get_solver_steps():
+    return _get_settings().get("solver_steps")
+
+
+def get_bg_fill_method():
+    return _get_settings().get("bg_fill_method")
+
+
+def get_savgol_window():
+    return _get_settings().get("savgol_window")
+
+
+def get_savgol_causal():
+    return _get_settings().get("savgol_causal")
+
+
+def get_precursor_hours():
+    return _get_settings().get("precursor_hours")
+
+
+def get_fetch_workers():
+    return _get_settings().get("fetch_workers")
+
+
+def get_simulation_cache_entries():
+    return _get_settings().get("simulation_cache_entries")
+
+
+def get_image_cache_entries():
+    return _get_settings().get("image_cache_entries")
+
+
+def get_image_cache_dir():
+    return _get_settings().get("image_cache_dir")
+
+
+def get_chart_width():
+    return _get_settings().get("chart_width")
+
+
+def get_chart_points_per_pixel():
+    return _get_settings().get("chart_points_per_pixel")
+
+
+def get_webgl_min_points():
+    return _get_settings().get("webgl_min_points")
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SimulationRun:
+    def __init__(self, start, params: tuple, inputs: np.ndarray, outputs: np.ndarray, states: np.ndarray,
+                 resumable: int):
+        self.start = start
+        self.params = params
+        self.inputs = inputs
+        self.outputs = outputs
+        self.states = states
+        self.resumable = resumable
+
+
+class SimulationCache:
+    # keeps the last simulation run per input stream, so a refresh only has to simulate the minutes
+    # from the first one where its input differs from the cached run. safe to share between threads
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self.runs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, start, params: tuple) -> SimulationRun:
+        with self.lock:
+            run = self.runs.get(key)
+            if run is None or run.start != start or run.params != params:
+                return None
+            self.runs.move_to_end(key)
+            return run
+
+    def lookup(self, key, start, params: tuple, inputs: np.ndarray) -> SimulationRun:
+        run = self.get(key, start, params)
+        if run is None or len(run.inputs) != len(inputs) or not np.array_equal(run.inputs, inputs):
+            return None
+        return run
+
+    def resume(self, key, start, params: tuple, inputs: np.ndarray) -> (int, np.ndarray, np.ndarray):
+        # number of leading minutes of inputs covered by the cached run, with their outputs and states
+        run = self.get(key, start, params)
+        if run is None:
+            return 0, None, None
+
+        n = min(len(inputs), len(run.inputs), run.resumable)
+        differs = np.flatnonzero(inputs[:n] != run.inputs[:n])
+        offset = int(differs[0]) if len(differs) > 0 else n
+        return offset, run.outputs[:offset], run.states[:offset]
+
+    def store(self, key, start, params: tuple, inputs: np.ndarray, outputs: np.ndarray, states: np.ndarray,
+              resumable: int = None):
+        if resumable is None:
+            resumable = len(inputs)
+        run = SimulationRun(start, params, np.array(inputs), outputs, states, resumable)
+        with self.lock:
+            self.runs[key] = run
+            self.runs.move_to_end(key)
+            while len(self.runs) > self.max_entries:
+                self.runs.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.runs.clear()
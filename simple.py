@@ -5,7 +5,12 @@ import pandas as pd
 import plotly.graph_objects as go
 
 from datamodel import *
+from downsample import MIN_MAX, downsample, get_scatter
 from plotly.subplots import make_subplots
+from renderer import ImageCache, ImageRenderer, get_model_key
+from settings import get_chart_points_per_pixel, get_chart_width, get_image_cache_dir, get_image_cache_entries, \
+    get_simulation_cache_entries, get_webgl_min_points
+from simcache import SimulationCache
 
 bgd_color_max = '#ffff00'
 bgd_color_mid = '#00ff00'
@@ -17,13 +22,26 @@ COLOR_BGD2 = ''#ff1933''
 
 import plotly.io as pio
 
+state_cache = SimulationCache(get_simulation_cache_entries())
+image_cache = ImageCache(get_image_cache_entries(), get_image_cache_dir())
+renderer = ImageRenderer()
 
-def render_simple(hours_prev: float, hours_next: float, no_show: bool = True, alt_act=None):
+
+def render_simple(hours_prev: float, hours_next: float, no_show: bool = True, alt_act=None, width: int = None,
+                  w: float = 50, h: float = 140):
+    if width is None:
+        width = get_chart_width()
     ts_now = dt.datetime.now().replace(second=0, microsecond=0).timestamp()
     ts_start = ts_now - hours_prev * 60 * 60
     ts_end = ts_now + hours_next * 60 * 60
 
-    df = get_data_model(ts_start, ts_end, 50, 140, alternative_action=alt_act)
+    df = get_data_model(ts_start, ts_end, w, h, alternative_action=alt_act, state_cache=state_cache)
+
+    if no_show:
+        image_key = get_model_key(df, chart='simple', alt_act=getattr(alt_act, '__qualname__', None), width=width)
+        image = image_cache.get(image_key)
+        if image is not None:
+            return image
 
     bgc = df[DF_C_BGC] / 18.02
     bgd = df[DF_C_BGC_DIFF] / 18.02 * -5
@@ -41,13 +59,21 @@ def render_simple(hours_prev: float, hours_next: float, no_show: bool = True, al
     insulin_bound = df[DF_C_PERIPHERAL_BOUND_INSULIN] + df[DF_C_LIVER_BOUND_INSULIN]
     insulin_onboard = insulin_free + insulin_bound
 
+    # a few points per pixel column are all a trace can show, however many days it spans
+    n_out = width * get_chart_points_per_pixel()
+    bgc = downsample(bgc, n_out)
+    bgd = downsample(bgd, n_out)
+    rates = downsample(rates, n_out, MIN_MAX)
+    insulin_bound = downsample(insulin_bound, n_out)
+    Scatter = get_scatter(max(len(bgc), len(bgd), len(rates), len(insulin_bound)), get_webgl_min_points())
+
     #figure = go.Figure()
     figure = make_subplots(rows=2, cols=1, shared_xaxes=True)
 
     figure.add_trace(
-        go.Scatter(
+        Scatter(
             name='bgc (mmol/l)',
-            x=df.index, y=bgc,
+            x=bgc.index, y=bgc,
             mode='lines',
             line=dict(
                 color='#ff1933',
@@ -57,9 +83,9 @@ def render_simple(hours_prev: float, hours_next: float, no_show: bool = True, al
     )
 
     figure.add_trace(
-        go.Scatter(
+        Scatter(
             name='rate (U/h)',
-            x=df.index, y=rates,
+            x=rates.index, y=rates,
             mode='lines',
             fill='tozeroy',
             fillcolor='rgba(80, 200, 200, 0.3)',
@@ -90,7 +116,7 @@ def render_simple(hours_prev: float, hours_next: float, no_show: bool = True, al
     )
 
     figure.add_trace(
-        go.Scatter(
+        Scatter(
             name='i bound',
             x=insulin_bound.index, y=insulin_bound,
             mode='lines',
@@ -104,9 +130,9 @@ def render_simple(hours_prev: float, hours_next: float, no_show: bool = True, al
     )
 
     figure.add_trace(
-        go.Scatter(
+        Scatter(
             name='bgd',
-            x=df.index, y=bgd,
+            x=bgd.index, y=bgd,
             mode='lines',
             fill = 'tozeroy',
                    fillcolor = 'rgba(200, 80, 70, 0.3)',
@@ -284,7 +310,9 @@ def render_simple(hours_prev: float, hours_next: float, no_show: bool = True, al
     if no_show:
         figure.layout.hidesources = True
         figure.layout.showlegend = False
-        return figure.to_image(format="png", engine="kaleido")
+        image = renderer.render(figure, format="png", width=width)
+        image_cache.put(image_key, image)
+        return image
     else:
         figure.show()
 
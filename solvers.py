@@ -0,0 +1,170 @@
+import numpy as np
+from scipy.integrate import solve_ivp
+
+EULER = 'euler'
+ADAPTIVE_SOLVERS = ['RK45', 'RK23', 'DOP853', 'Radau', 'BDF', 'LSODA']
+# the solvers using the jacobian of the right hand side, given to them analytically
+IMPLICIT_SOLVERS = ['Radau', 'BDF', 'LSODA']
+SOLVERS = [EULER] + ADAPTIVE_SOLVERS
+
+TAIL_CHUNK_MINUTES = 60
+# input changes larger than this fraction of the largest input are kept as steps between minutes of constant input
+SPLIT_JUMP = 0.01
+
+
+class NegativeCompartmentError(ArithmeticError):
+    pass
+
+
+class SolverError(RuntimeError):
+    pass
+
+
+def check_solver(solver: str):
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown solver {solver}, expected one of {', '.join(SOLVERS)}")
+
+
+def integrate_minutes(rhs, y0, u: np.ndarray, method: str, rtol: float, atol: float, args: tuple = (),
+                      jac=None) -> np.ndarray:
+    # y at the end of every minute of u, u being the input rate of each minute. an input constant per minute
+    # jumps at every minute boundary and keeps the solver from taking long steps, so where the input changes by
+    # no more than SPLIT_JUMP of its largest value from minute to minute it is joined linearly between the middles
+    # of the minutes instead and the whole stretch handed to the solver at once. the minutes next to larger
+    # changes, e.g. a bolus pulse, keep their constant input and are integrated run by run of equal input
+    n = len(u)
+    ys = np.empty((n, len(y0)))
+    y = np.array(y0, dtype=float)
+    if n == 0:
+        return ys
+    u = np.asarray(u, dtype=float)
+    slopes = np.append(np.diff(u), 0.)
+
+    def input_at(t):
+        x = t - 0.5
+        if x <= 0:
+            return u[0]
+        i = min(int(x), n - 1)
+        return u[i] + slopes[i] * (x - i)
+
+    def smooth_rhs(t, y, *args):
+        return rhs(t, y, input_at(t), *args)
+
+    options = {}
+    if jac is not None and method in IMPLICIT_SOLVERS:
+        # the input enters linearly, so the jacobian does not depend on it
+        options['jac'] = lambda t, y, *f_args: jac(t, y, 0., *args)
+
+    # minutes next to a jump or with the same input as both neighbours keep it constant
+    jumps = np.flatnonzero(np.abs(slopes[:-1]) > SPLIT_JUMP * np.abs(u).max())
+    constant = (slopes == 0) & (np.insert(slopes[:-1], 0, 0.) == 0)
+    constant[jumps] = True
+    constant[jumps + 1] = True
+    # smooth stretches end where constant minutes start, constant minutes where their input changes
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(constant) | (constant[1:] & (slopes[:-1] != 0))) + 1,
+                             [n]))
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        if constant[a]:
+            f, f_args = rhs, (u[a],) + tuple(args)
+        else:
+            f, f_args = smooth_rhs, tuple(args)
+        solution = solve_ivp(f, (a, b), y, method=method, t_eval=np.arange(a + 1, b + 1), rtol=rtol, atol=atol,
+                             args=f_args, **options)
+        if not solution.success:
+            raise SolverError(solution.message)
+        # tolerance sized undershoots below zero are not meaningful for compartment amounts
+        ys[a:b] = np.maximum(solution.y.T, 0.)
+        y = ys[b - 1]
+    return ys
+
+
+def absorption_rhs(t, y, u, k, ka1, ka2, vmld, kmld, coe):
+    q1a, q1b, q2, q3 = y
+    qi = max(q1a + q1b + q2, 0.)
+    kqi = 1 / (qi ** (2/3) * coe + 1)
+
+    lda = vmld*q1a/(kmld+q1a)
+    ldb = vmld*q1b/(kmld+q1b)
+
+    return [k*u - ka1*q1a - lda,
+            (1-k)*u - ka2*kqi*q1b - ldb,
+            ka1*kqi*q1a - ka1*kqi*q2,
+            ka1*kqi*q2 + ka2*kqi*q1b]
+
+
+def absorption_jac(t, y, u, k, ka1, ka2, vmld, kmld, coe):
+    q1a, q1b, q2, q3 = y
+    qi = max(q1a + q1b + q2, 0.)
+    kqi = 1 / (qi ** (2/3) * coe + 1)
+    dkqi = -2/3 * coe * qi ** (-1/3) * kqi ** 2 if qi > 0 else 0.
+
+    dlda = vmld*kmld/(kmld+q1a)**2
+    dldb = vmld*kmld/(kmld+q1b)**2
+
+    return [[-ka1 - dlda, 0., 0., 0.],
+            [-ka2*q1b*dkqi, -ka2*kqi - ka2*q1b*dkqi - dldb, -ka2*q1b*dkqi, 0.],
+            [ka1*kqi + ka1*(q1a-q2)*dkqi, ka1*(q1a-q2)*dkqi, -ka1*kqi + ka1*(q1a-q2)*dkqi, 0.],
+            [(ka1*q2 + ka2*q1b)*dkqi, ka2*kqi + (ka1*q2 + ka2*q1b)*dkqi, ka1*kqi + (ka1*q2 + ka2*q1b)*dkqi, 0.]]
+
+
+def action_rhs(t, y, u, k01, k21, k31, k12, k13, k42, k24, k53, k35, k04, k05, r4, r5):
+    q1, q2, q3, q4, q5 = y
+    f42 = k42*(1-q4/r4)*q2
+    f53 = k53*(1-q5/r5)*q3
+
+    return [-(k01+k21+k31)*q1 + k12*q2 + k13*q3 + u,
+            k21*q1 - k12*q2 - f42 + k24*q4,
+            k31*q1 - k13*q3 - f53 + k35*q5,
+            f42 - (k04+k24)*q4,
+            f53 - (k05+k35)*q5]
+
+
+def action_jac(t, y, u, k01, k21, k31, k12, k13, k42, k24, k53, k35, k04, k05, r4, r5):
+    q1, q2, q3, q4, q5 = y
+    # partial derivatives of f42 and f53 by the compartments they depend on
+    f42_q2, f42_q4 = k42*(1-q4/r4), -k42*q2/r4
+    f53_q3, f53_q5 = k53*(1-q5/r5), -k53*q3/r5
+
+    return [[-(k01+k21+k31), k12, k13, 0., 0.],
+            [k21, -k12 - f42_q2, 0., k24 - f42_q4, 0.],
+            [k31, 0., -k13 - f53_q3, 0., k35 - f53_q5],
+            [0., f42_q2, 0., f42_q4 - (k04+k24), 0.],
+            [0., 0., f53_q3, 0., f53_q5 - (k05+k35)]]
+
+
+def solve_absorption(u: np.ndarray, constants: tuple, method: str, rtol: float, atol: float,
+                     close_zero: float, state=None) -> (np.ndarray, np.ndarray):
+    # q3 per minute and the (q1a, q1b, q2) state at the end of each minute for one stream, continued past the end
+    # of u until the depots hold no more than close_zero, the same stopping rule as the euler simulation
+    if state is None:
+        state = (0., 0., 0.)
+    ys = integrate_minutes(absorption_rhs, tuple(state) + (0.,), u, method, rtol, atol, constants, absorption_jac)
+    tails = [ys]
+    y = ys[-1] if len(ys) > 0 else np.array(tuple(state) + (0.,))
+    while y[:3].sum() > close_zero:
+        tail = integrate_minutes(absorption_rhs, y, np.zeros(TAIL_CHUNK_MINUTES), method, rtol, atol, constants,
+                                 absorption_jac)
+        tails.append(tail)
+        y = tail[-1]
+    ys = np.concatenate(tails)
+
+    # the simulation ends at the first minute past the input that starts with close_zero or less left
+    remaining = np.concatenate(([sum(state)], ys[:, :3].sum(axis=1)))
+    ys = ys[:len(u) + np.flatnonzero(remaining[len(u):] <= close_zero)[0]]
+
+    absorbed = np.diff(ys[:, 3], prepend=0.)
+    return absorbed, ys[:, :3]
+
+
+def solve_action(u: np.ndarray, constants: tuple, method: str, rtol: float, atol: float, state=None) -> np.ndarray:
+    if state is None:
+        state = (0., 0., 0., 0., 0.)
+    return integrate_minutes(action_rhs, state, u, method, rtol, atol, constants, action_jac)
+
+
+def max_difference(a: np.ndarray, b: np.ndarray) -> float:
+    # largest absolute difference between two results, the shorter one padded with zeros
+    n = max(len(a), len(b))
+    a = np.concatenate((a, np.zeros((n - len(a),) + a.shape[1:])))
+    b = np.concatenate((b, np.zeros((n - len(b),) + b.shape[1:])))
+    return float(np.abs(a - b).max()) if n > 0 else 0.
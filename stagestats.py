@@ -0,0 +1,172 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+class StageStats:
+    # wall and cpu time of one run of a stage, cpu time being that of the thread it ran in, and counts of
+    # the items it went through. with profiling the outermost stage of each thread also keeps its profile
+    def __init__(self, name: str, thread: str, offset: float):
+        self.name = name
+        self.thread = thread
+        self.offset = offset
+        self.wall = None
+        self.cpu = None
+        self.counts = {}
+        self.allocated = None
+        self.profile = None
+
+    def count(self, **counts):
+        for name, n in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def as_dict(self) -> dict:
+        return {'name': self.name, 'thread': self.thread, 'offset': self.offset, 'wall': self.wall,
+                'cpu': self.cpu, 'counts': dict(self.counts), 'allocated': self.allocated}
+
+
+class _Stage:
+    def __init__(self, stats, name: str):
+        self.stats = stats
+        self.name = name
+        self.stage = None
+        self.profiler = None
+
+    def __enter__(self) -> StageStats:
+        stats = self.stats
+        local = stats.local
+        depth = getattr(local, 'depth', 0)
+        local.depth = depth + 1
+
+        self.stage = StageStats(self.name, threading.current_thread().name, time.perf_counter() - stats.started)
+        if stats.trace_memory:
+            self.allocated = tracemalloc.get_traced_memory()[0]
+        if stats.profile and depth == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self.stage
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stage = self.stage
+        stage.wall = time.perf_counter() - self.wall
+        stage.cpu = time.thread_time() - self.cpu
+        if self.profiler is not None:
+            self.profiler.disable()
+            stage.profile = self.profiler
+        if self.stats.trace_memory:
+            stage.allocated = tracemalloc.get_traced_memory()[0] - self.allocated
+        self.stats.local.depth -= 1
+        with self.stats.lock:
+            self.stats.stages.append(stage)
+        return False
+
+
+class _NoStage:
+    # what stage gives when stats are disabled, one shared object so a disabled stage costs a method call
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def count(self, **counts):
+        pass
+
+
+NO_STAGE = _NoStage()
+
+
+class ModelStats:
+    # the stages of a data model build with their times and counts, collected from every thread the build
+    # runs in. profile keeps a cProfile of the outermost stages and trace_memory the memory each stage
+    # allocated, traced with tracemalloc while the stats are open. memory allocated by stages running at the
+    # same time in other threads is counted in all of them
+    def __init__(self, enabled: bool = True, profile: bool = False, trace_memory: bool = False):
+        self.enabled = enabled
+        self.profile = enabled and profile
+        self.trace_memory = enabled and trace_memory
+        self.stages = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.wall = None
+        self.peak_memory = None
+        self.memory_snapshot = None
+        self.tracing = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+    def __deepcopy__(self, memo):
+        # pandas deep-copies the attrs of a frame with the frame, the copies share the stats of their build
+        return self
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return NO_STAGE
+        return _Stage(self, name)
+
+    def finish(self):
+        if not self.enabled or self.wall is not None:
+            return
+        self.wall = time.perf_counter() - self.started
+        if self.trace_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            self.memory_snapshot = tracemalloc.take_snapshot()
+            if self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+
+    def get(self, name: str) -> list:
+        return [stage for stage in self.stages if stage.name == name]
+
+    def get_totals(self) -> dict:
+        # wall and cpu time and counts summed over the runs of each stage, in the order they first finished
+        totals = {}
+        for stage in self.stages:
+            total = totals.setdefault(stage.name, {'runs': 0, 'wall': 0., 'cpu': 0., 'counts': {}})
+            total['runs'] += 1
+            total['wall'] += stage.wall
+            total['cpu'] += stage.cpu
+            for name, n in stage.counts.items():
+                total['counts'][name] = total['counts'].get(name, 0) + n
+        return totals
+
+    def as_dict(self) -> dict:
+        return {'wall': self.wall, 'peak_memory': self.peak_memory,
+                'stages': [stage.as_dict() for stage in self.stages]}
+
+    def get_profile(self, name: str = None, sort: str = 'cumulative', limit: int = 30) -> str:
+        # the merged profiles of the stages named name, or of all profiled stages
+        profiles = [stage.profile for stage in self.stages
+                    if stage.profile is not None and (name is None or stage.name == name)]
+        if len(profiles) == 0:
+            return ''
+        stream = io.StringIO()
+        pstats.Stats(*profiles, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def get_top_allocations(self, limit: int = 20) -> list:
+        if self.memory_snapshot is None:
+            return []
+        return self.memory_snapshot.statistics('lineno')[:limit]
+
+    def __str__(self) -> str:
+        lines = [f"{'stage':<24}{'runs':>6}{'wall ms':>12}{'cpu ms':>12}  counts"]
+        for name, total in self.get_totals().items():
+            counts = ' '.join(f"{k}={v}" for k, v in total['counts'].items())
+            lines.append(f"{name:<24}{total['runs']:>6}{total['wall'] * 1000:>12.2f}{total['cpu'] * 1000:>12.2f}"
+                         f"  {counts}")
+        if self.wall is not None:
+            lines.append(f"{'total':<24}{'':>6}{self.wall * 1000:>12.2f}")
+        if self.peak_memory is not None:
+            lines.append(f"peak traced memory {self.peak_memory / 1024 / 1024:.1f}MB")
+        return '\n'.join(lines)
+
+
+NO_STATS = ModelStats(enabled=False)
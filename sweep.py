@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+from datamodel import simulate_insulin_absorption_batch, insulin_action_constants, insulin_action_kernel, \
+    any_negative_array, ACTION_COLUMNS, DF_C_ABSORBED_INSULIN
+
+ABSORPTION_PARAMETERS = ['k', 'ka1', 'ka2', 'vmld', 'kmld', 'coe']
+ACTION_PARAMETERS = ['w', 'h', 'k01', 'k21', 'k42', 'k24', 'k04', 'r4', 'r5']
+
+SWEEP_INDEX_NAMES = ['parameter_set', 'time']
+
+
+def sweep_insulin_absorption(entries: pd.Series, parameter_sets: pd.DataFrame) -> pd.DataFrame:
+    # simulates the absorption of entries (mU/min) once per row of parameter_sets, whose columns are any of
+    # ABSORPTION_PARAMETERS with the model defaults used for the missing ones
+    absorbed = _sweep_absorption(entries, parameter_sets)
+    index = pd.date_range(start=entries.index[0], freq='T', periods=absorbed.shape[1])
+    return _tidy(absorbed[:, :, np.newaxis], parameter_sets.index, index, [DF_C_ABSORBED_INSULIN])
+
+
+def sweep_insulin_action(i_abs, parameter_sets: pd.DataFrame) -> pd.DataFrame:
+    # simulates q1..q5 for i_abs once per row of parameter_sets, whose columns are any of ACTION_PARAMETERS
+    # and must include w and h. i_abs is either one Series shared by all sets or a (minute x set)
+    # DataFrame with a column per row of parameter_sets
+    if isinstance(i_abs, pd.DataFrame):
+        index = i_abs.index
+        u = i_abs.to_numpy(dtype=float)
+    else:
+        index = i_abs.index
+        u = i_abs.to_numpy(dtype=float)[:, np.newaxis]
+
+    q = _sweep_action(u, parameter_sets)
+    return _tidy(q.transpose(2, 0, 1), parameter_sets.index, index, ACTION_COLUMNS)
+
+
+def sweep_insulin_model(entries: pd.Series, parameter_sets: pd.DataFrame) -> pd.DataFrame:
+    # absorption followed by action for every row of parameter_sets, which may mix ABSORPTION_PARAMETERS
+    # and ACTION_PARAMETERS
+    absorbed = _sweep_absorption(entries, parameter_sets)
+    q = _sweep_action(absorbed.T, parameter_sets)
+    index = pd.date_range(start=entries.index[0], freq='T', periods=absorbed.shape[1])
+    values = np.concatenate((absorbed[:, :, np.newaxis], q.transpose(2, 0, 1)), axis=2)
+    return _tidy(values, parameter_sets.index, index, [DF_C_ABSORBED_INSULIN] + ACTION_COLUMNS)
+
+
+def _sweep_absorption(entries: pd.Series, parameter_sets: pd.DataFrame) -> np.ndarray:
+    params = _parameter_columns(parameter_sets, ABSORPTION_PARAMETERS)
+    streams = np.tile(entries.to_numpy(dtype=float), (len(parameter_sets), 1))
+    return simulate_insulin_absorption_batch(streams, **params)
+
+
+def _sweep_action(u: np.ndarray, parameter_sets: pd.DataFrame) -> np.ndarray:
+    n_sets = len(parameter_sets)
+    params = _parameter_columns(parameter_sets, ACTION_PARAMETERS)
+    constants = insulin_action_constants(**params)
+    constants = tuple(np.broadcast_to(c, (n_sets,)) for c in constants[:-1]) + constants[-1:]
+
+    q = np.empty((len(u), 5, n_sets))
+    state = tuple(np.zeros(n_sets) for _ in range(5))
+    insulin_action_kernel(u, constants, state, q, any_negative_array)
+    return q
+
+
+def _parameter_columns(parameter_sets: pd.DataFrame, names: list) -> dict:
+    return {c: parameter_sets[c].to_numpy(dtype=float) for c in parameter_sets.columns if c in names}
+
+
+def _tidy(values: np.ndarray, sets: pd.Index, index: pd.Index, columns: list) -> pd.DataFrame:
+    # (set x minute x column) values as a frame indexed by parameter set and minute
+    n_sets, n_minutes, n_columns = values.shape
+    tidy_index = pd.MultiIndex.from_product([sets, index], names=SWEEP_INDEX_NAMES)
+    return pd.DataFrame(values.reshape(n_sets * n_minutes, n_columns), index=tidy_index, columns=columns)
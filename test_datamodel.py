@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datamodel import BATCH_VECTOR_MIN_STREAMS, simulate_insulin_absorption, simulate_insulin_absorption_batch
+
+
+def make_streams(n_streams: int, n_minutes: int, seed: int) -> np.ndarray:
+    # boluses, basal runs and quiet streams on a shared minute grid
+    rng = np.random.default_rng(seed)
+    entries = np.zeros((n_streams, n_minutes))
+    for row in range(n_streams):
+        kind = row % 3
+        if kind == 0:
+            entries[row, rng.integers(0, n_minutes)] = rng.uniform(500, 4000)
+        elif kind == 1:
+            start = rng.integers(0, n_minutes // 2)
+            entries[row, start:start + rng.integers(5, n_minutes // 2)] = rng.uniform(5, 30)
+        else:
+            pulses = rng.choice(n_minutes, 4, replace=False)
+            entries[row, pulses] = rng.uniform(50, 1000, 4)
+    return entries
+
+
+@pytest.mark.parametrize('n_streams', [5, BATCH_VECTOR_MIN_STREAMS + 4])
+def test_batch_matches_single_streams(n_streams: int):
+    entries = make_streams(n_streams, 90, n_streams)
+    index = pd.date_range('2020-01-01', periods=entries.shape[1], freq='T')
+    batch = simulate_insulin_absorption_batch(entries)
+
+    lengths = []
+    for row in range(n_streams):
+        single = simulate_insulin_absorption(pd.Series(entries[row], index)).to_numpy()
+        lengths.append(len(single))
+        np.testing.assert_allclose(batch[row, :len(single)], single, rtol=1e-9, atol=0)
+        assert not batch[row, len(single):].any()
+    assert batch.shape == (n_streams, max(lengths))
+
+
+def test_batch_of_quiet_streams():
+    entries = np.zeros((3, 30))
+    entries[1, 4] = 1000
+    batch = simulate_insulin_absorption_batch(entries)
+    assert not batch[[0, 2]].any()
+    single = simulate_insulin_absorption(pd.Series(entries[1], pd.date_range('2020-01-01', periods=30, freq='T')))
+    np.testing.assert_allclose(batch[1, :len(single)], single.to_numpy(), rtol=1e-9, atol=0)
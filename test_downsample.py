@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from downsample import LTTB, MIN_MAX, downsample
+
+
+@pytest.mark.parametrize('method', [LTTB, MIN_MAX])
+def test_short_runs_are_decimated(method: str):
+    values = np.sin(np.arange(40000) / 500)
+    values[::60] = np.nan
+    s = pd.Series(values)
+    downsampled = downsample(s, 1400, method)
+    # every run keeps its first and last point and the missing value after it
+    assert len(downsampled) <= 3 * values[::60].size
+    assert downsampled.isna().sum() == values[::60].size - 1
+
+
+@pytest.mark.parametrize('method', [LTTB, MIN_MAX])
+def test_long_runs_share_the_budget(method: str):
+    values = np.sin(np.arange(40000) / 500)
+    values[20000] = np.nan
+    downsampled = downsample(pd.Series(values), 1400, method)
+    assert len(downsampled) <= 1401
+    assert downsampled.index[0] == 0 and downsampled.index[-1] == 39999
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+from benchmark import SyntheticData
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_minute_entries_match_pulse_entries(seed: int):
+    data = SyntheticData(7, seed)
+    assert sum(len(ps.boluses) for ps in data.pod_sessions) > 0
+    for ps in data.pod_sessions:
+        minutes = ps.get_entries()
+        pulses = ps.get_entries(pulse_exact=True).resample('T').sum()
+        pulses = pulses[pulses.index >= minutes.index[0]]
+        pulses = pulses[:pulses.to_numpy().nonzero()[0][-1] + 1]
+        assert (minutes.index == pulses.index).all()
+        np.testing.assert_allclose(minutes.to_numpy(), pulses.to_numpy())
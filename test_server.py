@@ -0,0 +1,125 @@
+import datetime as dt
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import server
+from benchmark import TS_END, SyntheticData
+from nsomni import set_store
+from server import Coalescer, ModelServer
+
+
+def test_coalescer_runs_identical_keys_once():
+    coalescer = Coalescer(2)
+    calls = []
+    started = threading.Event()
+
+    def compute(x):
+        calls.append(x)
+        started.set()
+        time.sleep(0.2)
+        return x * 2
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(coalescer.run('key', compute, 21)))
+               for _ in range(5)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [21]
+    assert results == [42] * 5
+    assert coalescer.pending == {}
+
+
+def test_coalescer_raises_for_every_waiter():
+    coalescer = Coalescer(2)
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError("failed")
+
+    errors = []
+
+    def run():
+        try:
+            coalescer.run('key', fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 4
+    assert coalescer.pending == {}
+
+
+class SyntheticNow(dt.datetime):
+    # the synthetic history ends at TS_END, so the server's now is put there
+    @classmethod
+    def now(cls, tz=None):
+        return dt.datetime.fromtimestamp(TS_END, tz)
+
+
+@pytest.fixture(scope='module')
+def url(tmp_path_factory):
+    set_store(SyntheticData(2, 0).get_store(str(tmp_path_factory.mktemp('store') / 'store.db')))
+    model_server = ModelServer(('127.0.0.1', 0), 2, 50, 140)
+    thread = threading.Thread(target=model_server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{model_server.server_address[1]}"
+    model_server.shutdown()
+    model_server.server_close()
+    set_store(None)
+
+
+@pytest.fixture(autouse=True)
+def synthetic_now(monkeypatch):
+    monkeypatch.setattr(server.dt, 'datetime', SyntheticNow)
+
+
+def get(url: str) -> (int, bytes):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def test_model_json(url: str):
+    status, body = get(f"{url}/model?hours_prev=3&hours_next=1")
+    assert status == 200
+    model = json.loads(body)
+    assert len(model['index']) == 4 * 60 + 1
+    bgc = [row[model['columns'].index('bgc')] for row in model['data']]
+    assert any(value is not None for value in bgc)
+
+
+def test_model_columns(url: str):
+    status, body = get(f"{url}/model?hours_prev=3&hours_next=1&columns=bgc,insulin_infusion_rate")
+    assert status == 200
+    assert json.loads(body)['columns'] == ['bgc', 'insulin_infusion_rate']
+
+
+def test_model_unknown_columns(url: str):
+    status, _ = get(f"{url}/model?hours_prev=3&hours_next=1&columns=bgc,unknown")
+    assert status == 400
+
+
+def test_model_arrow_without_pyarrow(url: str, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    status, _ = get(f"{url}/model?hours_prev=3&hours_next=1&format=arrow")
+    assert status == 501
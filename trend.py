@@ -0,0 +1,162 @@
+from collections import deque
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+
+@lru_cache(maxsize=256)
+def savgol_coefficients(window_length: int, polyorder: int, deriv: int, delta: float) -> np.ndarray:
+    # row p holds the coefficients of the fit over window_length samples evaluated at the p-th of them,
+    # the middle row is the usual centered filter and the others evaluate the fit at the edges like mode='interp'
+    coefficients = np.stack([signal.savgol_coeffs(window_length, polyorder, deriv=deriv, delta=delta, pos=p,
+                                                  use='dot') for p in range(window_length)])
+    coefficients.flags.writeable = False
+    return coefficients
+
+
+def causal_savgol_coefficients(window_length: int, polyorder: int, deriv: int, delta: float) -> list:
+    # coefficients of the fit over the last n samples evaluated at the newest one, by n. None where n is too
+    # short to fit the polynomial
+    coefficients = [None] * (polyorder + 1)
+    for n in range(polyorder + 1, window_length + 1):
+        coefficients.append(savgol_coefficients(n, polyorder, deriv, delta)[n - 1])
+    return coefficients
+
+
+def savgol_bank(ts: pd.Series, filters: list, delta: float = 1.0) -> dict:
+    # centered savitzky-golay filters of ts by (window_length, polyorder, deriv). the centered coefficients of
+    # all filters are padded to the longest window and convolved with the samples in one overlap-add pass. each
+    # run of valid samples is filtered on its own with the edges fitted like mode='interp', so a missing sample
+    # does not spread into its neighbours. runs shorter than a window are fitted over their whole length,
+    # missing samples stay missing
+    values = ts.to_numpy(dtype=float)
+    filtered = {f: np.full(len(values), np.nan) for f in filters}
+
+    valid = ~np.isnan(values)
+    changes = np.flatnonzero(np.diff(np.concatenate(([False], valid, [False])).astype(int)))
+    for start, end in zip(changes[::2], changes[1::2]):
+        segment = values[start:end]
+        n = end - start
+        fitting = [f for f in filters if f[0] <= n]
+        for f in filters:
+            if f[0] > n >= f[1] + 1:
+                filtered[f][start:end] = savgol_coefficients(n, f[1], f[2], delta) @ segment
+        if len(fitting) == 0:
+            continue
+
+        longest = max(f[0] for f in fitting)
+        kernels = np.zeros((longest, len(fitting)))
+        for i, (window_length, polyorder, deriv) in enumerate(fitting):
+            offset = longest // 2 - window_length // 2
+            kernels[offset:offset + window_length, i] = savgol_coefficients(window_length, polyorder, deriv,
+                                                                            delta)[window_length // 2]
+        # the value centered on sample p is at p + longest - 1 - longest // 2 of the full convolution
+        convolved = signal.oaconvolve(segment[:, None], kernels[::-1], mode='full', axes=0)
+        shift = longest - 1 - longest // 2
+
+        for i, f in enumerate(fitting):
+            window_length = f[0]
+            half = window_length // 2
+            c = savgol_coefficients(window_length, f[1], f[2], delta)
+            out = filtered[f][start:end]
+            out[half:n - window_length + half + 1] = convolved[half + shift:n - window_length + half + 1 + shift, i]
+            out[:half] = c[:half] @ segment[:window_length]
+            out[n - window_length + half + 1:] = c[half + 1:] @ segment[n - window_length:]
+
+    return {f: pd.Series(v, ts.index) for f, v in filtered.items()}
+
+
+def causal_savgol_filter(ts: pd.Series, window_length: int, polyorder: int, deriv: int, delta: float) -> pd.Series:
+    # savitzky-golay over the samples up to each one instead of around it, the same values CausalSavgol
+    # gives when fed ts one sample at a time
+    coefficients = causal_savgol_coefficients(window_length, polyorder, deriv, delta)
+    values = ts.to_numpy(dtype=float)
+    filtered = np.full(len(values), np.nan)
+    valid = ~np.isnan(values)
+    changes = np.flatnonzero(np.diff(np.concatenate(([False], valid, [False])).astype(int)))
+    for start, end in zip(changes[::2], changes[1::2]):
+        # the first samples of a segment are fitted over the shorter window behind them
+        for i in range(start + polyorder, min(end, start + window_length - 1)):
+            filtered[i] = coefficients[i - start + 1] @ values[start:i + 1]
+        if end - start >= window_length:
+            filtered[start + window_length - 1:end] = np.convolve(values[start:end], coefficients[window_length][::-1],
+                                                                  mode='valid')
+    return pd.Series(filtered, ts.index)
+
+
+class CausalSavgol:
+    # streaming causal savitzky-golay filter of a regularly sampled series. each new sample is fitted together
+    # with the window_length - 1 samples before it, in O(window_length) and without going over the history
+    # again. a missing sample or a skipped step starts a new segment, whose first samples are fitted over the
+    # shorter window behind them
+    def __init__(self, window_length: int, polyorder: int, deriv: int = 1, delta: float = 1.0,
+                 freq: str = 'T'):
+        self.window_length = window_length
+        self.step = pd.tseries.frequencies.to_offset(freq).delta
+        self.coefficients = causal_savgol_coefficients(window_length, polyorder, deriv, delta)
+        self.buffer = deque(maxlen=window_length)
+        self.last_ts = None
+        self.inputs = {}
+        self.outputs = {}
+
+    def update(self, ts: pd.Timestamp, value: float) -> float:
+        if self.last_ts is None or ts - self.last_ts != self.step or np.isnan(value):
+            self.buffer.clear()
+        self.last_ts = ts
+        self.inputs[ts] = value
+        if np.isnan(value):
+            filtered = np.nan
+        else:
+            self.buffer.append(value)
+            c = self.coefficients[len(self.buffer)]
+            filtered = np.nan if c is None else float(np.dot(c, self.buffer))
+        self.outputs[ts] = filtered
+        return filtered
+
+    def filter(self, ts: pd.Series) -> pd.Series:
+        # filters the samples of ts past the last one seen. earlier samples keep the value they were given
+        # when they arrived, unless their input has changed since, e.g. a cgm backfilling after signal loss or
+        # gaps filled again from a newer sample, in which case the filter goes back to the first changed one
+        if len(ts) == 0:
+            return pd.Series(dtype=float, index=ts.index)
+        self.prune(ts.index[0] - self.step * self.window_length)
+
+        start = None if self.last_ts is None else self.last_ts + self.step
+        changed = self.get_changed(ts)
+        if changed is not None:
+            start = changed
+            for t in [t for t in self.outputs if t >= start]:
+                del self.outputs[t]
+                del self.inputs[t]
+            # refills the buffer from the samples of the segment before the first changed one
+            before = ts[start - self.step * (self.window_length - 1):start - self.step].to_numpy(dtype=float)
+            missing = np.flatnonzero(np.isnan(before))
+            self.buffer.clear()
+            self.buffer.extend(before[missing[-1] + 1:] if len(missing) > 0 else before)
+            self.last_ts = start - self.step
+
+        for t, value in (ts if start is None else ts[start:]).items():
+            self.update(t, value)
+        return pd.Series(self.outputs, dtype=float).reindex(ts.index)
+
+    def get_changed(self, ts: pd.Series):
+        # the first sample of ts already filtered whose value differs from the one it was filtered with
+        if len(self.inputs) == 0:
+            return None
+        seen = ts[(ts.index >= min(self.inputs)) & (ts.index <= self.last_ts)]
+        current = seen.to_numpy(dtype=float)
+        previous = pd.Series(self.inputs, dtype=float).reindex(seen.index).to_numpy()
+        changed = np.flatnonzero((current != previous) & ~(np.isnan(current) & np.isnan(previous)))
+        return seen.index[changed[0]] if len(changed) > 0 else None
+
+    def prune(self, before: pd.Timestamp):
+        self.inputs = {t: value for t, value in self.inputs.items() if t >= before}
+        self.outputs = {t: value for t, value in self.outputs.items() if t >= before}
+
+    def reset(self):
+        self.buffer.clear()
+        self.last_ts = None
+        self.inputs = {}
+        self.outputs = {}